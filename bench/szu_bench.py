@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2014-2015 the Sanzang authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Sanzang benchmark suite for the szu programs."""
+
+
+import getopt
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import szu_ed  # noqa: E402
+import szu_r  # noqa: E402
+import szu_ss  # noqa: E402
+import szu_t  # noqa: E402
+
+
+USAGE = """Usage: szu_bench.py [options]
+
+Benchmark the Sanzang programs with synthetic CJK texts and tables.
+
+Options:
+  -d, --data-dir   directory for generated data (default: temporary)
+  -g, --golden     compare output digests with a golden file
+  -h, --help       print this help message and exit
+  -M, --no-memory  do not measure peak memory (faster)
+  -r, --rules      table sizes, e.g. "1k,10k" (default "1k,10k")
+  -s, --seed       random seed for generated data (default 1)
+  -t, --text       text sizes, e.g. "1M,10M" (default "1M")
+  -w, --write      write output digests to a golden file
+
+Sizes may use the suffixes k, M, and G. Table sizes count rules, and text
+sizes count bytes of UTF-8 text. Supported scales range from 1k to 1M rules
+and from 1M to 1G of text. The replace engine of szu-t is skipped for the
+largest combinations, where it would take hours.
+
+"""
+
+CJK_FIRST = 0x4e00
+CJK_COUNT = 6000
+PUNCT = '，。：；？！、「」『』'
+SYLLABLES = ['an', 'ba', 'chen', 'de', 'fa', 'guan', 'jing', 'li', 'ming',
+             'pu', 'ru', 'shi', 'wu', 'xin', 'yi', 'zhi']
+
+REPLACE_LIMIT = 10 ** 11
+
+
+def parse_size(text):
+    """Parse a size such as "10k" or "1G" into an integer."""
+    scale = {'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9}
+    if text[-1:] in scale:
+        return int(text[:-1]) * scale[text[-1]]
+    return int(text)
+
+
+def size_name(size):
+    """Return a short name for a size, such as "10k" or "1G"."""
+    for suffix, scale in (('G', 10 ** 9), ('M', 10 ** 6), ('k', 10 ** 3)):
+        if size >= scale and size % scale == 0:
+            return '%d%s' % (size // scale, suffix)
+    return str(size)
+
+
+def make_terms(rng, count):
+    """Generate a list of distinct CJK source terms."""
+    terms = set()
+    while len(terms) < count:
+        length = rng.choice((1, 2, 2, 2, 3, 3, 4, 5))
+        terms.add(''.join(chr(CJK_FIRST + rng.randrange(CJK_COUNT))
+                          for _ in range(length)))
+    terms = sorted(terms)
+    rng.shuffle(terms)
+    return terms
+
+
+def write_table(fpath, terms, rng):
+    """Write a sorted three-column translation table for terms."""
+    tab = {}
+    for term in terms:
+        pinyin = ' '.join(rng.choice(SYLLABLES) for _ in term)
+        tab[term] = [pinyin, 'g' + pinyin.replace(' ', '-')]
+    with open(fpath, 'w', encoding='utf-8') as fout:
+        fout.write(szu_ed.table_to_str(tab))
+
+
+def write_ss_table(fpath, rng):
+    """Write a two-column variant table, mostly of single characters."""
+    rows = []
+    for _ in range(2000):
+        src = chr(CJK_FIRST + rng.randrange(CJK_COUNT))
+        dst = chr(CJK_FIRST + rng.randrange(CJK_COUNT))
+        rows.append((src, dst))
+    for _ in range(200):
+        src = ''.join(chr(CJK_FIRST + rng.randrange(CJK_COUNT))
+                      for _ in range(2))
+        rows.append((src, 'Ab' + src))
+    rows.sort(key=lambda row: (-len(row[0]), row[0]))
+    with open(fpath, 'w', encoding='utf-8') as fout:
+        for src, dst in rows:
+            fout.write(src + '|' + dst + '\n')
+
+
+def write_text(fpath, terms, size, rng):
+    """
+    Write a CBETA-style text of about the given size in bytes.
+
+    Lines have CBETA margins, and consist of table terms chosen with a
+    skewed distribution, other CJK characters, and punctuation.
+
+    """
+    hot = terms[:max(1, len(terms) // 10)]
+    written = 0
+    page = 1
+    line = 1
+    with open(fpath, 'w', encoding='utf-8') as fout:
+        while written < size:
+            lines = []
+            for _ in range(1000):
+                parts = []
+                for _ in range(rng.randrange(4, 12)):
+                    roll = rng.random()
+                    if roll < 0.5:
+                        parts.append(rng.choice(hot))
+                    elif roll < 0.7:
+                        parts.append(rng.choice(terms))
+                    elif roll < 0.9:
+                        parts.append(chr(CJK_FIRST + rng.randrange(CJK_COUNT)))
+                    else:
+                        parts.append(rng.choice(PUNCT))
+                margin = 'T01n0001_p%04da%02d║' % (page, line)
+                lines.append(margin + ''.join(parts) + '\n')
+                line += 1
+                if line > 29:
+                    page += 1
+                    line = 1
+            chunk = ''.join(lines)
+            fout.write(chunk)
+            written += len(chunk.encode('utf-8'))
+
+
+def prepare(data_dir, rules, text_size, seed):
+    """Generate (or reuse) the data files for one scale. Return paths."""
+    tag = '%s-%s-%d' % (size_name(rules), size_name(text_size), seed)
+    paths = {
+        'table': os.path.join(data_dir, 'table-%s-%d.txt' % (
+            size_name(rules), seed)),
+        'ss_table': os.path.join(data_dir, 'ss-table-%d.txt' % seed),
+        'text': os.path.join(data_dir, 'text-%s.txt' % tag)}
+    rng = random.Random(seed * 1000003 + rules)
+    terms = make_terms(rng, rules)
+    if not os.path.exists(paths['table']):
+        write_table(paths['table'], terms, rng)
+    if not os.path.exists(paths['ss_table']):
+        write_ss_table(paths['ss_table'], random.Random(seed))
+    if not os.path.exists(paths['text']):
+        write_text(paths['text'], terms, text_size,
+                   random.Random(seed * 7919 + text_size))
+    return paths
+
+
+class DigestWriter:
+    """A write-only file object that keeps a digest and a byte count."""
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.digest.update(data)
+        self.size += len(data)
+        return len(text)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+def read_text_table(fpath):
+    """Read a szu-t table from a file path."""
+    with open(fpath, 'r', encoding='utf-8-sig') as fin:
+        return szu_t.read_table(fin)
+
+
+def case_tr(engine):
+    """Return a benchmark function for szu_t.tr_file with an engine."""
+    def run(paths, out):
+        table = read_text_table(paths['table'])
+        matcher = szu_t.make_matcher(table) if engine == 'trie' else None
+        with open(paths['text'], 'r', encoding='utf-8-sig') as fin:
+            szu_t.tr_file(table, fin, out, matcher=matcher)
+    return run
+
+
+def case_reflow(paths, out):
+    """Benchmark szu_r.reflow_file."""
+    with open(paths['text'], 'r', encoding='utf-8-sig') as fin:
+        szu_r.reflow_file(fin, out)
+
+
+def case_subst(engine):
+    """Return a benchmark function for szu_ss.subst_file with an engine."""
+    def run(paths, out):
+        with open(paths['ss_table'], 'r', encoding='utf-8-sig') as fin:
+            table = szu_ss.read_ss_table(fin)
+        matcher, cascade, runs = None, None, None
+        if engine in ('compat', 'trie'):
+            matcher = szu_ss.make_matcher(table)
+        if engine == 'compat':
+            cascade = szu_ss.cascade_rules(table)
+        if engine in ('compat', 'translate'):
+            runs = szu_ss.char_runs(table)
+        with open(paths['text'], 'r', encoding='utf-8-sig') as fin:
+            szu_ss.subst_file(table, fin, out, matcher=matcher,
+                              cascade=cascade, runs=runs)
+    return run
+
+
+def case_table_to_str(paths, out):
+    """Benchmark szu_ed.read_table and szu_ed.table_to_str."""
+    with open(paths['table'], 'r', encoding='utf-8-sig') as fin:
+        tab, _ = szu_ed.read_table(fin.read())
+    out.write(szu_ed.table_to_str(tab))
+
+
+# Each case is (name, group, function, input). Cases in the same group must
+# produce identical output, and input names the file measured for
+# throughput.
+CASES = [
+    ('szu_t.tr_file/replace', 'tr', case_tr('replace'), 'text'),
+    ('szu_t.tr_file/trie', 'tr', case_tr('trie'), 'text'),
+    ('szu_r.reflow_file', 'reflow', case_reflow, 'text'),
+    ('szu_ss.subst_file/replace', 'subst', case_subst('replace'), 'text'),
+    ('szu_ss.subst_file/translate', 'subst', case_subst('translate'),
+     'text'),
+    ('szu_ss.subst_file/compat', 'subst', case_subst('compat'), 'text'),
+    ('szu_ss.subst_file/trie', 'subst-trie', case_subst('trie'), 'text'),
+    ('szu_ed.table_to_str', 'table', case_table_to_str, 'table'),
+]
+
+
+def run_case(func, paths, memory):
+    """Run one case. Return (seconds, peak bytes or None, digest)."""
+    out = DigestWriter()
+    start = time.perf_counter()
+    func(paths, out)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func(paths, DigestWriter())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak, out.hexdigest()
+
+
+def benchmark(rule_sizes, text_sizes, data_dir, seed, memory):
+    """Run all cases at all scales. Return a list of result records."""
+    results = []
+    for rules in rule_sizes:
+        for text_size in text_sizes:
+            paths = prepare(data_dir, rules, text_size, seed)
+            for name, group, func, source in CASES:
+                if name.endswith('/replace') and \
+                        rules * text_size > REPLACE_LIMIT:
+                    continue
+                if group != 'tr' and group != 'table' and \
+                        rules != rule_sizes[0]:
+                    continue
+                if group == 'table' and text_size != text_sizes[0]:
+                    continue
+                elapsed, peak, digest = run_case(func, paths, memory)
+                size = os.path.getsize(paths[source])
+                result = {
+                    'case': name, 'group': group,
+                    'rules': size_name(rules), 'text': size_name(text_size),
+                    'seconds': elapsed, 'bytes': size,
+                    'mb_per_s': size / elapsed / 10 ** 6 if elapsed else 0,
+                    'peak': peak, 'digest': digest}
+                results.append(result)
+                report(result)
+    return results
+
+
+def report(result):
+    """Print one result line."""
+    peak = '-' if result['peak'] is None else '%.1f' % (
+        result['peak'] / 2 ** 20)
+    print('%-28s %6s rules %6s text %9.3f s %8.2f MB/s %9s MiB  %s' % (
+        result['case'], result['rules'], result['text'], result['seconds'],
+        result['mb_per_s'], peak, result['digest'][:12]))
+    sys.stdout.flush()
+
+
+def report_scaling(results):
+    """Print the scaling exponent of each case between scales."""
+    print('\nScaling (time ~ size^k):')
+    series = {}
+    for res in results:
+        series.setdefault(res['case'], []).append(res)
+    for name, runs in series.items():
+        for prev, cur in zip(runs, runs[1:]):
+            for axis in ('text', 'rules'):
+                other = 'rules' if axis == 'text' else 'text'
+                if prev[other] != cur[other] or prev[axis] == cur[axis]:
+                    continue
+                ratio = parse_size(cur[axis]) / parse_size(prev[axis])
+                if prev['seconds'] > 0 and cur['seconds'] > 0:
+                    k = math.log(cur['seconds'] / prev['seconds']) / \
+                        math.log(ratio)
+                    print('%-28s %s %s -> %s: k = %.2f' % (
+                        name, axis, prev[axis], cur[axis], k))
+
+
+def check_groups(results):
+    """Check that cases in the same group produced identical output."""
+    errors = 0
+    seen = {}
+    for res in results:
+        key = (res['group'], res['rules'], res['text'])
+        if key in seen and seen[key]['digest'] != res['digest']:
+            print('MISMATCH: %s and %s differ at %s rules, %s text' % (
+                seen[key]['case'], res['case'], res['rules'], res['text']))
+            errors += 1
+        seen.setdefault(key, res)
+    return errors
+
+
+def check_golden(results, golden_fpath):
+    """Compare output digests with those recorded in a golden file."""
+    with open(golden_fpath, 'r', encoding='utf-8') as fin:
+        golden = json.load(fin)
+    errors = 0
+    for res in results:
+        key = '%s %s %s' % (res['case'], res['rules'], res['text'])
+        if key in golden and golden[key] != res['digest']:
+            print('GOLDEN MISMATCH: ' + key)
+            errors += 1
+    return errors
+
+
+def write_golden(results, golden_fpath):
+    """Record the output digests of all results in a golden file."""
+    golden = {}
+    for res in results:
+        golden['%s %s %s' % (res['case'], res['rules'], res['text'])] = \
+            res['digest']
+    with open(golden_fpath, 'w', encoding='utf-8') as fout:
+        json.dump(golden, fout, indent=1, sort_keys=True)
+        fout.write('\n')
+
+
+def main(argv):
+    """Run the benchmark suite as a command-line program."""
+    rule_sizes = [1000, 10000]
+    text_sizes = [10 ** 6]
+    data_dir = None
+    seed = 1
+    memory = True
+    golden_in = None
+    golden_out = None
+    try:
+        opts, _ = getopt.getopt(
+            argv[1:], 'd:g:hMr:s:t:w:',
+            ['data-dir=', 'golden=', 'help', 'no-memory', 'rules=', 'seed=',
+             'text=', 'write='])
+        for option, value in opts:
+            if option in ('-d', '--data-dir'):
+                data_dir = value
+            if option in ('-g', '--golden'):
+                golden_in = value
+            if option in ('-h', '--help'):
+                print(USAGE, end='')
+                return 0
+            if option in ('-M', '--no-memory'):
+                memory = False
+            if option in ('-r', '--rules'):
+                rule_sizes = [parse_size(v) for v in value.split(',')]
+            if option in ('-s', '--seed'):
+                seed = int(value)
+            if option in ('-t', '--text'):
+                text_sizes = [parse_size(v) for v in value.split(',')]
+            if option in ('-w', '--write'):
+                golden_out = value
+    except (getopt.GetoptError, ValueError) as err:
+        sys.stderr.write('szu_bench: ' + str(err) + '\n')
+        return 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if data_dir is None:
+            data_dir = tmp_dir
+        os.makedirs(data_dir, exist_ok=True)
+        results = benchmark(rule_sizes, text_sizes, data_dir, seed, memory)
+    report_scaling(results)
+    errors = check_groups(results)
+    if golden_in is not None:
+        errors += check_golden(results, golden_in)
+    if golden_out is not None:
+        write_golden(results, golden_out)
+    if errors > 0:
+        print('\n%d output mismatches' % errors)
+        return 1
+    print('\nAll outputs consistent.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.stdout = io.TextIOWrapper(
+        sys.stdout.detach(), encoding='utf-8', line_buffering=True)
+    sys.exit(main(sys.argv))
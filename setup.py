@@ -12,7 +12,7 @@ setup(
     # Basic information
     #
     name='sanzang',
-    version='1.3.4',
+    version='1.4.0',
     author='yaoguai',
     url='https://github.com/yaoguai/sanzang',
     license='MIT',
@@ -40,15 +40,21 @@ setup(
     # Included Python files
     #
     scripts=[
+        'szu-b',
         'szu-ed',
+        'szu-p',
         'szu-r',
         'szu-ss',
         'szu-t'],
     py_modules=[
+        'szu_b',
         'szu_ed',
+        'szu_nfc',
+        'szu_p',
         'szu_r',
         'szu_ss',
-        'szu_t'],
+        'szu_t',
+        'szu_table'],
     data_files=[
         ('share/doc/sanzang', [
             'AUTHORS.rst',
@@ -56,7 +62,9 @@ setup(
             'LICENSE.rst',
             'README.rst']),
         ('share/man/man1', [
+            'szu-b.1',
             'szu-ed.1',
+            'szu-p.1',
             'szu-r.1',
             'szu-ss.1',
             'szu-t.1'])]
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2014-2015 the Sanzang authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Sanzang program module for batch translation of directory trees."""
+
+
+import fnmatch
+import getopt
+import hashlib
+import io
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+import szu_nfc
+import szu_p
+import szu_ss
+import szu_t
+
+
+USAGE = """Usage: szu-b [options] -o output_dir table_file path ...
+
+Translate the files in directory trees into a mirrored output directory.
+
+Options:
+  -c, --cache      load the table through a compiled cache file
+  -e, --engine     matching engine: "replace" (default) or "trie"
+  -g, --glob       pattern for the names of input files (default "*.txt")
+  -h, --help       print this help message and exit
+  -H, --hash       compare content hashes instead of modification times
+  -j, --jobs       number of worker processes (default 1)
+  -n, --no-reflow  do not reformat the text before substitution
+  -o, --output-dir write each translation to a mirrored path in a directory
+  -s, --subst      make substitutions with a two-column table first
+  -v, --verbose    print the progress for each file, and a summary
+
+"""
+
+MANIFEST_NAME = '.szu-b.manifest'
+
+_WORKER = {}
+
+
+def set_stdio_utf8():
+    """
+    Set standard I/O streams to UTF-8.
+
+    Attempt to reassign standard I/O streams to new streams using UTF-8.
+    Standard input should discard any leading BOM. If an error is raised,
+    assume the environment is inflexible but correct (IDLE).
+
+    """
+    try:
+        sys.stdin = io.TextIOWrapper(
+            sys.stdin.detach(), encoding='utf-8-sig', line_buffering=True)
+        sys.stdout = io.TextIOWrapper(
+            sys.stdout.detach(), encoding='utf-8', line_buffering=True)
+        sys.stderr = io.TextIOWrapper(
+            sys.stderr.detach(), encoding='utf-8', line_buffering=True)
+    except io.UnsupportedOperation:
+        pass
+
+
+def find_files(paths, pattern='*.txt', exclude=None):
+    """
+    Find the input files for a batch (generator).
+
+    Each path that is a directory is searched recursively, in sorted order,
+    for files with names that match the pattern. Other paths are taken as
+    they are. A (path, relative path) pair is yielded for each file, where
+    the relative path is that of the file under the directory it was found
+    in, or else the name of the file. A directory to exclude, such as the
+    output directory, may be given as an absolute path.
+
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path, os.path.basename(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(
+                name for name in dirs
+                if os.path.abspath(os.path.join(root, name)) != exclude)
+            for name in sorted(files):
+                if fnmatch.fnmatch(name, pattern):
+                    fpath = os.path.join(root, name)
+                    yield fpath, os.path.relpath(fpath, path)
+
+
+def file_digest(fpath, settings=''):
+    """Return the SHA-1 digest of a file, after a string of settings."""
+    sha = hashlib.sha1(settings.encode('utf-8'))
+    with open(fpath, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_manifest(out_dir):
+    """
+    Read the manifest of an output directory. Return a dictionary.
+
+    The manifest maps the path of each output file, relative to the output
+    directory, to the digest of the settings that it was made with, and of
+    its input file if content hashes are compared. Each line is a digest
+    and a path, and a later line for a path replaces an earlier one. A
+    missing manifest is empty.
+
+    """
+    manifest = {}
+    fpath = os.path.join(out_dir, MANIFEST_NAME)
+    if os.path.exists(fpath):
+        with open(fpath, 'r', encoding='utf-8') as fin:
+            for line in fin:
+                if line.endswith('\n') and ' ' in line:
+                    digest, rel_path = line[:-1].split(' ', 1)
+                    manifest[rel_path] = digest
+    return manifest
+
+
+def write_manifest(out_dir, manifest):
+    """Replace the manifest of an output directory atomically."""
+    fpath = os.path.join(out_dir, MANIFEST_NAME)
+    tmp_fpath = '%s.%d.tmp' % (fpath, os.getpid())
+    with open(tmp_fpath, 'w', encoding='utf-8') as fout:
+        for rel_path in sorted(manifest):
+            fout.write('%s %s\n' % (manifest[rel_path], rel_path))
+    os.replace(tmp_fpath, fpath)
+
+
+def up_to_date(in_path, out_path, mtime_ns):
+    """
+    Check if an output file is newer than its input file and the tables.
+
+    The output is up to date if it exists, and if it was modified no
+    earlier than the input file and the given time, which is the latest
+    modification time of the tables.
+
+    """
+    try:
+        out_mtime = os.stat(out_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    return out_mtime >= max(os.stat(in_path).st_mtime_ns, mtime_ns)
+
+
+def temp_path(out_path):
+    """Return the path of the temporary file for an output file."""
+    return out_path + '.tmp'
+
+
+def plan_batch(in_files, out_dir, manifest, settings, use_hash=False,
+               mtime_ns=0):
+    """
+    Find the files of a batch that are not up to date. Return the tasks.
+
+    The input files are given as (path, relative path) pairs, as yielded
+    by find_files(), and each is mirrored at its relative path in the
+    output directory. An output is up to date if it exists and the
+    manifest has its digest: the digest of its input file and the string
+    of settings if use_hash is true, or else the digest of the settings,
+    in which case up_to_date() must also be true for it, given the time.
+    The result is a list of (input path, output path, digest) tasks, and
+    the number of outputs up to date. An input file given more than once
+    is only included once, but a RuntimeError is raised if two different
+    input files would have the same output path.
+
+    """
+    tasks = []
+    current = 0
+    sources = {}
+    settings_digest = hashlib.sha1(settings.encode('utf-8')).hexdigest()
+    for in_path, rel_path in in_files:
+        out_path = os.path.join(out_dir, rel_path)
+        source = os.path.realpath(in_path)
+        if out_path in sources:
+            if sources[out_path] != source:
+                raise RuntimeError('Input files have the same output path: '
+                                   + rel_path)
+            continue
+        sources[out_path] = source
+        if use_hash:
+            digest = file_digest(in_path, settings)
+            fresh = os.path.exists(out_path)
+        else:
+            digest = settings_digest
+            fresh = up_to_date(in_path, out_path, mtime_ns)
+        if fresh and manifest.get(rel_path) == digest:
+            current += 1
+            continue
+        tasks.append((in_path, out_path, digest))
+    return tasks, current
+
+
+def translate_path(in_path, out_path, job):
+    """
+    Translate one file into an output file. Return (size, seconds).
+
+    The file is passed through szu_p.pipeline() with the tables and other
+    arguments in the job dictionary. The output is written to a temporary
+    file next to the output file, creating any missing directories, and
+    then it replaces the output file, so that an interrupted batch never
+    leaves a partial output file that looks up to date.
+
+    """
+    start = time.perf_counter()
+    out_dir = os.path.dirname(out_path)
+    if out_dir != '':
+        os.makedirs(out_dir, exist_ok=True)
+    tmp_path = temp_path(out_path)
+    try:
+        with open(in_path, 'r', encoding='utf-8-sig') as fin:
+            with open(tmp_path, 'w', encoding='utf-8') as fout:
+                szu_p.pipeline([fin], fout, **job)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return os.path.getsize(in_path), time.perf_counter() - start
+
+
+def _init_worker(job):
+    """
+    Store the tables and settings of a batch for a worker process.
+
+    Workers ignore SIGINT, so that an interrupted batch is stopped by the
+    main process, which terminates the workers and cleans up after them.
+
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _WORKER['job'] = job
+
+
+def _translate_task(task, job):
+    """Translate the file for a task. Return the result, or the error."""
+    try:
+        return translate_path(task[0], task[1], job)
+    except Exception as err:
+        return err
+
+
+def _batch_worker(task):
+    """Translate one file in a worker process. Return the task and result."""
+    renormalized = szu_nfc.COUNTS.copy()
+    result = _translate_task(task, _WORKER['job'])
+    return task, result, szu_nfc.COUNTS - renormalized
+
+
+def run_batch(tasks, job, jobs=1, fd_log=None, manifest=None, out_dir=None):
+    """
+    Translate a batch of files, in parallel if jobs > 1.
+
+    Each task is an (input path, output path, digest) tuple, and the files
+    are translated with translate_path(), by a pool of worker processes
+    that each receive the job once. Files are finished in any order. If a
+    log file object is given, then a line of progress is written to it for
+    each file. If a manifest dictionary is given, then the digest of each
+    file is recorded in it, and appended to the manifest file in the output
+    directory as soon as the file is finished, so that the work is kept if
+    the batch is interrupted. Errors for single files are written to
+    stderr, and the other files are still translated. When the batch ends,
+    even if it is interrupted, any temporary files left by the workers are
+    removed. Return a dictionary with the number of files done and failed,
+    and the bytes and seconds.
+
+    """
+    totals = {'done': 0, 'failed': 0, 'bytes': 0, 'seconds': 0.0}
+    fd_manifest = None
+    if manifest is not None:
+        fd_manifest = open(os.path.join(out_dir, MANIFEST_NAME), 'a',
+                           encoding='utf-8')
+    try:
+        if jobs == 1:
+            results = ((task, _translate_task(task, job), None)
+                       for task in tasks)
+            _batch_done(results, len(tasks), fd_log, manifest, fd_manifest,
+                        out_dir, totals)
+        else:
+            with multiprocessing.Pool(jobs, _init_worker, (job,)) as pool:
+                results = pool.imap_unordered(_batch_worker, tasks)
+                _batch_done(results, len(tasks), fd_log, manifest,
+                            fd_manifest, out_dir, totals)
+    finally:
+        if fd_manifest is not None:
+            fd_manifest.close()
+        for _, out_path, _ in tasks:
+            if os.path.exists(temp_path(out_path)):
+                os.remove(temp_path(out_path))
+    return totals
+
+
+def _batch_done(results, count, fd_log, manifest, fd_manifest, out_dir,
+                totals):
+    """Record the results of a batch as they are finished."""
+    for (in_path, out_path, digest), result, renormalized in results:
+        if renormalized is not None:
+            szu_nfc.COUNTS.update(renormalized)
+        if isinstance(result, Exception):
+            sys.stderr.write('szu-b: %s: %s\n' % (in_path, result))
+            totals['failed'] += 1
+            continue
+        size, seconds = result
+        totals['done'] += 1
+        totals['bytes'] += size
+        totals['seconds'] += seconds
+        if manifest is not None:
+            rel_path = os.path.relpath(out_path, out_dir)
+            manifest[rel_path] = digest
+            fd_manifest.write('%s %s\n' % (digest, rel_path))
+            fd_manifest.flush()
+        if fd_log is not None:
+            fd_log.write('szu-b: [%d/%d] %s: %d bytes in %.3f s\n' % (
+                totals['done'] + totals['failed'], count, in_path, size,
+                seconds))
+
+
+def main(argv):
+    """
+    Run szu-b as a portable command-line program.
+
+    Progress and errors are written to the standard error stream as UTF-8
+    text. Broken pipes and SIGINT are handled silently, and files that
+    were finished are kept, so that the batch can be run again to resume.
+
+    """
+    set_stdio_utf8()
+    if 'SIGPIPE' in dir(signal):
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    try:
+        verbose = False
+        cache = False
+        engine = 'replace'
+        pattern = '*.txt'
+        use_hash = False
+        jobs = 1
+        reflow = True
+        out_dir = None
+        ss_fpath = None
+        opts, args = getopt.getopt(
+            argv[1:], 'ce:g:hHj:no:s:v',
+            ['cache', 'engine=', 'glob=', 'hash', 'help', 'jobs=',
+             'no-reflow', 'output-dir=', 'subst=', 'verbose'])
+        for option, value in opts:
+            if option in ('-c', '--cache'):
+                cache = True
+            if option in ('-e', '--engine'):
+                if value not in ('replace', 'trie'):
+                    raise RuntimeError('Unknown engine: ' + value)
+                engine = value
+            if option in ('-g', '--glob'):
+                pattern = value
+            if option in ('-h', '--help'):
+                print(USAGE, end='')
+                return 0
+            if option in ('-H', '--hash'):
+                use_hash = True
+            if option in ('-j', '--jobs'):
+                if not value.isdigit() or int(value) < 1:
+                    raise RuntimeError('Invalid number of jobs: ' + value)
+                jobs = int(value)
+            if option in ('-n', '--no-reflow'):
+                reflow = False
+            if option in ('-o', '--output-dir'):
+                out_dir = value
+            if option in ('-s', '--subst'):
+                ss_fpath = value
+            if option in ('-v', '--verbose'):
+                verbose = True
+        if len(args) < 2 or out_dir is None:
+            sys.stderr.write(USAGE)
+            return 1
+        start = time.perf_counter()
+        table_fpaths = [args[0]] if ss_fpath is None else [args[0], ss_fpath]
+        if use_hash:
+            tables = [file_digest(fpath) for fpath in table_fpaths]
+        else:
+            tables = [os.path.abspath(fpath) for fpath in table_fpaths]
+        settings = '%s %s %s\n' % (
+            '|'.join(tables), engine, 'reflow' if reflow else 'no-reflow')
+        mtime_ns = max(os.stat(fpath).st_mtime_ns for fpath in table_fpaths)
+        manifest = read_manifest(out_dir)
+        in_files = find_files(args[1:], pattern, os.path.abspath(out_dir))
+        tasks, current = plan_batch(in_files, out_dir, manifest, settings,
+                                    use_hash, mtime_ns)
+        if verbose:
+            sys.stderr.write('szu-b: %d files to translate, %d up to date\n'
+                             % (len(tasks), current))
+        job = {'reflow': reflow}
+        job['table'], job['matcher'] = szu_t.open_table(
+            args[0], engine, cache)
+        if ss_fpath is not None:
+            with open(ss_fpath, 'r', encoding='utf-8-sig') as table_fd:
+                job['ss_table'] = szu_ss.read_ss_table(table_fd)
+            job['ss_options'] = {
+                'matcher': szu_ss.make_matcher(job['ss_table']),
+                'cascade': szu_ss.cascade_rules(job['ss_table']),
+                'runs': szu_ss.char_runs(job['ss_table']),
+                'steps': szu_ss.rule_steps(job['ss_table'])}
+        os.makedirs(out_dir, exist_ok=True)
+        totals = run_batch(tasks, job, jobs, sys.stderr if verbose else None,
+                           manifest, out_dir)
+        write_manifest(out_dir, manifest)
+        if verbose:
+            elapsed = time.perf_counter() - start
+            sys.stderr.write(
+                'szu-b: %d files, %d bytes in %.3f s (%.2f MB/s), %.3f s of '
+                'work with %d jobs, %d failed\n' % (
+                    totals['done'], totals['bytes'], elapsed,
+                    totals['bytes'] / elapsed / 10 ** 6 if elapsed else 0,
+                    totals['seconds'], jobs, totals['failed']))
+            sys.stderr.write('szu-b: ' + szu_nfc.summary() + '\n')
+        return 1 if totals['failed'] > 0 else 0
+    except KeyboardInterrupt:
+        print()
+        return 1
+    except Exception as err:
+        if verbose:
+            raise
+        else:
+            sys.stderr.write('szu-b: ' + str(err) + '\n')
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -23,12 +23,20 @@
 """Sanzang program module for table editing."""
 
 
+import bisect
+import collections
 import getopt
+import heapq
 import io
+import itertools
 import os
 import signal
+import stat
 import sys
-import unicodedata
+import tempfile
+
+import szu_nfc
+import szu_table
 
 try:
     import readline
@@ -37,14 +45,24 @@ except ImportError:
 
 
 USAGE = r"""Usage: szu-ed [options] table_file
+       szu-ed --apply=changes_file table_file
+       szu-ed --merge [--prefer=first|last|error] table_file ...
+       szu-ed --diff old_table new_table
 
 Command-line editor for Sanzang translation tables.
 
 Options:
+  -a, --apply      apply the commands in a file, and write the table once
+  -d, --diff       print the differences between two sorted tables
   -h, --help       print this help message and exit
+  -J, --journal    save changes to a journal, and write the table on exit
+  -m, --merge      merge sorted tables and print the result
+  -P, --prefer     rule to keep in a merge conflict (default "last")
 
 Mode-setting commands:
   \get    print the rule for a source term
+  \find   print the rules with source terms containing a string
+  \prefix print the rules with source terms starting with a string
   \set    set a translation rule
   \rm     remove a translation rule
 
@@ -56,6 +74,8 @@ Instant commands:
 
 """
 
+JOURNAL_LIMIT = 10000
+
 
 def set_stdio_utf8():
     """
@@ -83,22 +103,23 @@ def read_table(tab_str):
 
     Given a translation table as a formatted string, load the contents and
     return them as a dictionary. The keys are source terms (column 1),
-    while each value is a list of the corresponding terms.
+    while each value is a list of the corresponding terms. The dictionary
+    is a szu_table.TableMap, which keeps the rules in a compact table.
 
     """
-    tab_str = unicodedata.normalize('NFC', tab_str)
-    tab = {}
+    tab_str = szu_nfc.nfc(tab_str)
+    lines = []
     width = -1
     for line in tab_str.split('\n'):
         rec = [f.strip() for f in line.split('|')]
         if width != -1 and width == len(rec):
-            tab[rec[0]] = rec[1:]
+            lines.append('|'.join(rec))
         elif width == -1 and len(rec) > 1:
             width = len(rec)
-            tab[rec[0]] = rec[1:]
+            lines.append('|'.join(rec))
         elif line.strip() != '':
             raise RuntimeError('Table error: ' + line.strip())
-    return tab, width
+    return szu_table.TableMap(szu_table.Table.from_lines(lines)), width
 
 
 def table_to_str(tab):
@@ -109,22 +130,402 @@ def table_to_str(tab):
     table as text in the translation table format for storage.
 
     """
-    table_str = ''
     items = list(tab.items())
     items.sort(key=lambda x: (-len(x[0]), x[0]))
-    for i in items:
-        table_str += i[0] + '|' + '|'.join(i[1]) + '\n'
-    return table_str
+    return ''.join(i[0] + '|' + '|'.join(i[1]) + '\n' for i in items)
+
+
+def iter_table(fd_in, name='table'):
+    """
+    Read the rules of a sorted translation table one at a time.
 
+    Given an open file object for a table in the sorted order written by
+    table_to_str(), yield a (key, record) tuple for each rule, where the
+    key gives the sort order of the rule and the record is the list of its
+    fields. A RuntimeError is raised if the table is not in sorted order,
+    or if its rules do not all have the same number of fields.
 
-def edit(table_fpath, input_lines=None):
+    """
+    width = -1
+    last = None
+    for line in fd_in:
+        line = szu_nfc.nfc(line)
+        rec = [f.strip() for f in line.split('|')]
+        if width == -1 and len(rec) > 1:
+            width = len(rec)
+        elif len(rec) != width:
+            if line.strip() == '':
+                continue
+            raise RuntimeError('Table error: ' + line.strip())
+        key = (-len(rec[0]), rec[0])
+        if last is not None and key < last:
+            raise RuntimeError('Table not sorted: %s: %s' % (name, rec[0]))
+        last = key
+        yield key, rec
+
+
+def merge_tables(fds_in, fd_out, prefer='last', names=None):
+    """
+    Merge sorted translation tables into one sorted table.
+
+    Given a sequence of open file objects for sorted tables, write the
+    union of their rules to fd_out in sorted order. Only one rule from
+    each table is held in memory at a time. If tables have different rules
+    for the same source term, then prefer selects the rule to keep: the
+    rule from the "first" or "last" table in the sequence, or "error" to
+    raise a RuntimeError. Tables of different widths are also an error,
+    which is raised before anything is written. Return the number of rules
+    written and the number of conflicts.
+
+    """
+    if names is None:
+        names = ['table %d' % (n + 1) for n in range(len(fds_in))]
+    tables = []
+    widths = set()
+    for fd_in, name in zip(fds_in, names):
+        rules = iter_table(fd_in, name)
+        first = next(rules, None)
+        if first is not None:
+            widths.add(len(first[1]))
+            tables.append(itertools.chain([first], rules))
+    if len(widths) > 1:
+        raise RuntimeError('Tables have different widths: ' +
+                           ', '.join(str(width) for width in sorted(widths)))
+    count = 0
+    conflicts = 0
+    merged = heapq.merge(*tables, key=lambda item: item[0])
+    for _, group in itertools.groupby(merged, key=lambda item: item[0]):
+        recs = [rec for _, rec in group]
+        widths.update(len(rec) for rec in recs)
+        if len(widths) > 1:
+            raise RuntimeError('Tables have different widths: ' + recs[0][0])
+        if any(rec != recs[0] for rec in recs):
+            conflicts += 1
+            if prefer == 'error':
+                raise RuntimeError('Conflicting rules: ' + recs[0][0])
+        rec = recs[0] if prefer == 'first' else recs[-1]
+        fd_out.write('|'.join(rec) + '\n')
+        count += 1
+    return count, conflicts
+
+
+def diff_tables(fd_old, fd_new, fd_out):
+    """
+    Compare two sorted translation tables, and write their differences.
+
+    Both tables are read at the same time in sorted order, so only one rule
+    from each is held in memory. A rule only in the old table is written
+    as "-" and the rule, a rule only in the new table as "+" and the rule,
+    and a changed rule as "<" and the old rule followed by ">" and the new
+    rule. Return a dictionary counting the rules added, changed, and
+    removed.
+
+    """
+    counts = {'added': 0, 'changed': 0, 'removed': 0}
+    old = iter_table(fd_old, 'old table')
+    new = iter_table(fd_new, 'new table')
+    old_item = next(old, None)
+    new_item = next(new, None)
+    while old_item is not None or new_item is not None:
+        if new_item is None or (
+                old_item is not None and old_item[0] < new_item[0]):
+            fd_out.write('-' + '|'.join(old_item[1]) + '\n')
+            counts['removed'] += 1
+            old_item = next(old, None)
+        elif old_item is None or new_item[0] < old_item[0]:
+            fd_out.write('+' + '|'.join(new_item[1]) + '\n')
+            counts['added'] += 1
+            new_item = next(new, None)
+        else:
+            if old_item[1] != new_item[1]:
+                fd_out.write('<' + '|'.join(old_item[1]) + '\n')
+                fd_out.write('>' + '|'.join(new_item[1]) + '\n')
+                counts['changed'] += 1
+            old_item = next(old, None)
+            new_item = next(new, None)
+    return counts
+
+
+def table_stamp(table_fpath):
+    """Return a string identifying the size and version of a table file."""
+    st = os.stat(table_fpath)
+    return '%d %d' % (st.st_size, st.st_mtime_ns)
+
+
+def write_table(tab, table_fpath):
+    """
+    Write a translation table to a file atomically.
+
+    The table is written to a temporary file in the same directory, which
+    then replaces the table file, so that the table file is never left
+    partly written.
+
+    """
+    tmp_fpath, _ = write_temp_table(tab, table_fpath)
+    os.replace(tmp_fpath, table_fpath)
+
+
+def write_temp_table(tab, table_fpath):
+    """
+    Write a translation table to a temporary file next to a table file.
+
+    The file is synced to disk, and has the permissions of any existing
+    table file. Return the path of the temporary file and its stamp, as
+    given by table_stamp(), which it keeps when it replaces the table.
+
+    """
+    table_dir = os.path.dirname(os.path.abspath(table_fpath))
+    fd, tmp_fpath = tempfile.mkstemp(prefix='.szu-ed-', dir=table_dir)
+    try:
+        with open(fd, 'w', encoding='utf-8') as fout:
+            fout.write(table_to_str(tab))
+            fout.flush()
+            os.fsync(fout.fileno())
+        if os.path.exists(table_fpath):
+            os.chmod(tmp_fpath, stat.S_IMODE(os.stat(table_fpath).st_mode))
+        return tmp_fpath, table_stamp(tmp_fpath)
+    except BaseException:
+        os.remove(tmp_fpath)
+        raise
+
+
+class Journal:
+    """
+    An append-only journal of changes to a translation table.
+
+    The journal is kept next to the table file, with ".journal" added to
+    its name. The first line is "#" and the stamp of the table file that
+    the journal applies to. Each change is then one line: "+" and a rule
+    that was set, or "-" and a source term that was removed. A line of "="
+    commits the changes before it, and is written when the table is saved.
+    When the journal is compacted into the table file, a line of "!" and
+    the stamp of the new table file is written before the journal is
+    removed, so that an interrupted compaction can be recognized.
+
+    """
+
+    def __init__(self, table_fpath):
+        self.table_fpath = table_fpath
+        self.fpath = table_fpath + '.journal'
+        self.fd_out = None
+        self.committed = 0
+        self.undo = []
+
+    def replay(self, tab, width):
+        """
+        Apply the committed changes in an existing journal to a table.
+
+        Return the table width and the number of changes applied. Changes
+        that were never committed are ignored. If the journal was made for
+        a different version of the table file, then it is not applied, but
+        set aside with ".stale" added to its name and reported on stderr.
+
+        """
+        if not os.path.exists(self.fpath):
+            return width, 0
+        with open(self.fpath, 'r', encoding='utf-8') as fin:
+            # The last line is empty, or else it was left partly written.
+            lines = fin.read().split('\n')
+        stamp = table_stamp(self.table_fpath)
+        lines.pop()
+        if len(lines) > 0 and lines[-1] == '!' + stamp:
+            return width, 0
+        if len(lines) == 0 or lines[0] != '#' + stamp:
+            stale_fpath = self.fpath + '.stale'
+            os.replace(self.fpath, stale_fpath)
+            sys.stderr.write('"%s" (journal does not match table, moved to '
+                             '"%s")\n' % (self.table_fpath, stale_fpath))
+            return width, 0
+        changes = []
+        count = 0
+        for line in lines[1:]:
+            if line == '=':
+                for toks in changes:
+                    if toks[0] == '+':
+                        if width == -1:
+                            width = len(toks) - 1
+                        tab[toks[1]] = toks[2:]
+                    else:
+                        tab.pop(toks[1], None)
+                count += len(changes)
+                changes = []
+            elif line.startswith('+') and (
+                    width == -1 or len(line.split('|')) == width):
+                changes.append(['+'] + line[1:].split('|'))
+            elif line.startswith('-'):
+                changes.append(['-', line[1:]])
+            elif not line.startswith('!'):
+                raise RuntimeError('Journal error (remove or rename "%s" to '
+                                   'open the table): %s' % (self.fpath, line))
+        return width, count
+
+    def record(self, tab, term, value):
+        """Set (or remove, if value is None) a rule, and journal it."""
+        if self.fd_out is None:
+            self.fd_out = open(self.fpath, 'w', encoding='utf-8')
+            self.fd_out.write('#' + table_stamp(self.table_fpath) + '\n')
+        if value is None:
+            self.fd_out.write('-' + term + '\n')
+        else:
+            self.fd_out.write('+' + term + '|' + '|'.join(value) + '\n')
+        self.fd_out.flush()
+        self.undo.append((term, tab.get(term)))
+        if value is None:
+            del tab[term]
+        else:
+            tab[term] = value
+
+    def commit(self):
+        """Commit the journaled changes, and sync the journal to disk."""
+        if self.fd_out is None or len(self.undo) == 0:
+            return
+        self.fd_out.write('=\n')
+        self.fd_out.flush()
+        os.fsync(self.fd_out.fileno())
+        self.committed += len(self.undo)
+        self.undo = []
+
+    def rollback(self, tab):
+        """Undo the changes made to a table since the last commit."""
+        while len(self.undo) > 0:
+            term, value = self.undo.pop()
+            if value is None:
+                tab.pop(term, None)
+            else:
+                tab[term] = value
+
+    def compact(self, tab):
+        """Write the table file, and remove the journal."""
+        tmp_fpath, stamp = write_temp_table(tab, self.table_fpath)
+        if self.fd_out is None and os.path.exists(self.fpath):
+            self.fd_out = open(self.fpath, 'a', encoding='utf-8')
+        if self.fd_out is not None:
+            self.fd_out.write('!' + stamp + '\n')
+            self.fd_out.flush()
+            os.fsync(self.fd_out.fileno())
+        os.replace(tmp_fpath, self.table_fpath)
+        self.discard()
+
+    def discard(self):
+        """Remove the journal."""
+        if self.fd_out is not None:
+            self.fd_out.close()
+            self.fd_out = None
+        if os.path.exists(self.fpath):
+            os.remove(self.fpath)
+        self.committed = 0
+        self.undo = []
+
+
+class TermIndex:
+    """
+    An index of the source terms of a table for searching.
+
+    Source terms are kept in a sorted list for prefix search, and in an
+    inverted index from each character to the terms that contain it for
+    substring search. The index is updated as terms are added and removed,
+    so it only needs to be built once.
+
+    """
+
+    def __init__(self, terms):
+        self.keys = sorted(terms)
+        self.chars = collections.defaultdict(set)
+        for term in self.keys:
+            for char in term:
+                self.chars[char].add(term)
+
+    def add(self, term):
+        """Add a source term, if it is not already in the index."""
+        pos = bisect.bisect_left(self.keys, term)
+        if pos == len(self.keys) or self.keys[pos] != term:
+            self.keys.insert(pos, term)
+            for char in term:
+                self.chars[char].add(term)
+
+    def remove(self, term):
+        """Remove a source term from the index."""
+        pos = bisect.bisect_left(self.keys, term)
+        if pos < len(self.keys) and self.keys[pos] == term:
+            del self.keys[pos]
+            for char in set(term):
+                self.chars[char].discard(term)
+                if len(self.chars[char]) == 0:
+                    del self.chars[char]
+
+    def prefix(self, text):
+        """Return the source terms that begin with a string."""
+        pos = bisect.bisect_left(self.keys, text)
+        terms = []
+        while pos < len(self.keys) and self.keys[pos].startswith(text):
+            terms.append(self.keys[pos])
+            pos += 1
+        return terms
+
+    def find(self, text):
+        """Return the source terms that contain a string."""
+        sets = sorted((self.chars.get(char, set()) for char in set(text)),
+                      key=len)
+        if len(sets) == 0 or len(sets[0]) == 0:
+            return []
+        return [term for term in sets[0].intersection(*sets[1:])
+                if text in term]
+
+
+def read_input():
+    """Yield lines from the standard input until the end of input."""
+    try:
+        while True:
+            yield input()
+    except EOFError:
+        return
+
+
+def net_counts(original, tab):
+    """
+    Count the rules added, changed, and removed by a series of edits.
+
+    Given a dictionary of the original value of each term that was edited
+    (None for a term that was not in the table) and the edited table, the
+    counts are the net differences, so that a rule added and then removed
+    again is not counted at all. Return a dictionary of the counts.
+
+    """
+    counts = {'added': 0, 'changed': 0, 'removed': 0}
+    for term, old in original.items():
+        new = tab.get(term)
+        if old is None and new is not None:
+            counts['added'] += 1
+        elif old is not None and new is None:
+            counts['removed'] += 1
+        elif old != new:
+            counts['changed'] += 1
+    return counts
+
+
+def edit(table_fpath, input_lines=None, journal=False, batch=False):
     """
     Open a translation table and run editor commands.
 
     Editor commands are read from standard input by default, and non-error
     output is written to standard output. Errors are printed to standard
-    error. If a list of input lines is also specified, then read editor
-    input from this list instead of the standard input.
+    error. If an iterable of input lines (such as a list or an open file)
+    is also specified, then read editor input from it instead of the
+    standard input.
+
+    Any committed changes left in a journal by an earlier session are
+    applied when the table is opened, and written to the table file. If
+    journal is true, then changes are recorded in the journal as they are
+    made, and saving commits them to the journal instead of writing the
+    whole table. The table file is written when the journal grows longer
+    than JOURNAL_LIMIT changes, and when editing ends.
+
+    If batch is true, then all changes are applied in memory, and the
+    table is written once at the end if anything has changed. Changes are
+    not printed, and a summary of the rules added, changed, and removed is
+    printed instead. Write commands are ignored, and quit commands end the
+    input. The summary counts are the net changes made to the table, and
+    they are returned as a dictionary.
 
     """
     if not os.path.exists(table_fpath):
@@ -133,58 +534,115 @@ def edit(table_fpath, input_lines=None):
     else:
         with open(table_fpath, 'r', encoding='utf-8-sig') as fin:
             tab, width = read_table(fin.read())
+    log = Journal(table_fpath)
+    width, count = log.replay(tab, width)
+    if count > 0:
+        log.compact(tab)
+        sys.stderr.write('"%s" (%d changes recovered)\n' % (
+            table_fpath, count))
+    else:
+        log.discard()
+    journal = journal and not batch
+    original = {}
+    index = None
     cmd = '\\set'
-    try:
-        while True:
-            if input_lines is None:
-                line = unicodedata.normalize('NFC', input().strip())
-            elif len(input_lines) > 0:
-                line = unicodedata.normalize('NFC', input_lines.pop(0).strip())
+    for line in read_input() if input_lines is None else input_lines:
+        line = szu_nfc.nfc(line.strip())
+        if line in ('\\find', '\\get', '\\prefix', '\\rm', '\\set'):
+            cmd = line
+        elif line == '\\p':
+            print(table_to_str(tab), end='')
+        elif line == '\\q':
+            break
+        elif batch and line in ('\\w', '\\wq'):
+            if line == '\\wq':
+                break
+        elif line == '\\w' or line == '\\wq':
+            if not journal:
+                write_table(tab, table_fpath)
+                sys.stderr.write('"%s" (%d lines)\n' % (
+                    table_fpath, len(tab)))
+            elif log.committed + len(log.undo) >= JOURNAL_LIMIT:
+                log.compact(tab)
+                sys.stderr.write('"%s" (%d lines)\n' % (
+                    table_fpath, len(tab)))
             else:
-                return
-            if line in ('\\get', '\\rm', '\\set'):
-                cmd = line
-            elif line == '\\p':
-                print(table_to_str(tab), end='')
-            elif line == '\\q':
-                return
-            elif line == '\\w' or line == '\\wq':
-                with open(table_fpath, 'w', encoding='utf-8') as fout:
-                    fout.write(table_to_str(tab))
-                sys.stderr.write('"%s" (%d lines)\n' % (table_fpath, len(tab)))
-                if line == '\\wq':
-                    return
-            elif line != '' and not line.startswith('\\'):
-                if cmd == '\\get':
-                    try:
-                        print('%s|%s' % (line, '|'.join(tab[line])))
-                    except KeyError:
-                        sys.stderr.write('Not found: ' + line + '\n')
-                elif cmd == '\\rm':
-                    if line in tab:
+                log.commit()
+                sys.stderr.write('"%s" (%d lines, %d changes in journal)'
+                                 '\n' % (table_fpath, len(tab),
+                                         log.committed))
+            if line == '\\wq':
+                break
+        elif line != '' and not line.startswith('\\'):
+            if cmd == '\\get':
+                try:
+                    print('%s|%s' % (line, '|'.join(tab[line])))
+                except KeyError:
+                    sys.stderr.write('Not found: ' + line + '\n')
+            elif cmd in ('\\find', '\\prefix'):
+                if index is None:
+                    index = TermIndex(tab)
+                if cmd == '\\find':
+                    terms = index.find(line)
+                else:
+                    terms = index.prefix(line)
+                terms.sort(key=lambda x: (-len(x), x))
+                for term in terms:
+                    print('%s|%s' % (term, '|'.join(tab[term])))
+                if len(terms) == 0:
+                    sys.stderr.write('Not found: ' + line + '\n')
+            elif cmd == '\\rm':
+                if line in tab:
+                    original.setdefault(line, tab[line])
+                    if not batch:
                         old = line + '|' + '|'.join(tab[line])
                         sys.stderr.write('; --- ' + old + '\n')
-                        del tab[line]
+                    if journal:
+                        log.record(tab, line, None)
                     else:
-                        sys.stderr.write('Not found: ' + line + '\n')
-                elif cmd == '\\set':
-                    toks = [f.strip() for f in line.split('|')]
-                    if width == -1 and len(toks) > 1:
-                        width = len(toks)
-                    if len(toks) == width:
+                        del tab[line]
+                    if index is not None:
+                        index.remove(line)
+                else:
+                    sys.stderr.write('Not found: ' + line + '\n')
+            elif cmd == '\\set':
+                toks = [f.strip() for f in line.split('|')]
+                if width == -1 and len(toks) > 1:
+                    width = len(toks)
+                if len(toks) == width:
+                    original.setdefault(toks[0], tab.get(toks[0]))
+                    if not batch:
                         if toks[0] in tab:
                             old = toks[0] + '|' + '|'.join(tab[toks[0]])
                             sys.stderr.write('; --- ' + old + '\n')
                         sys.stderr.write('; +++ ' + '|'.join(toks) + '\n')
-                        tab[toks[0]] = toks[1:]
+                    if journal:
+                        log.record(tab, toks[0], toks[1:])
                     else:
-                        sys.stderr.write('Invalid assignment: ' + line + '\n')
-            elif line.strip() == '':
-                pass
-            else:
-                sys.stderr.write('Syntax error: ' + line + '\n')
-    except EOFError:
-        return
+                        tab[toks[0]] = toks[1:]
+                    if index is not None:
+                        index.add(toks[0])
+                else:
+                    sys.stderr.write('Invalid assignment: ' + line + '\n')
+        elif line.strip() == '':
+            pass
+        else:
+            sys.stderr.write('Syntax error: ' + line + '\n')
+    log.rollback(tab)
+    if log.committed > 0:
+        log.compact(tab)
+    else:
+        log.discard()
+    counts = net_counts(original, tab)
+    if batch:
+        if sum(counts.values()) > 0:
+            write_table(tab, table_fpath)
+        sys.stderr.write('"%s" (%d lines): %d added, %d changed, %d removed'
+                         '\n' % (table_fpath, len(tab), counts['added'],
+                                 counts['changed'], counts['removed']))
+        if szu_nfc.COUNTS['bytes'] > 0:
+            sys.stderr.write('"%s": %s\n' % (table_fpath, szu_nfc.summary()))
+    return counts
 
 
 def main(argv):
@@ -200,19 +658,62 @@ def main(argv):
     if 'SIGPIPE' in dir(signal):
         signal.signal(signal.SIGPIPE, signal.SIG_DFL)
     try:
-        opts, args = getopt.getopt(argv[1:], 'h', ['help'])
-        for option, _ in opts:
+        journal = False
+        changes_fpath = None
+        mode = None
+        prefer = 'last'
+        opts, args = getopt.getopt(
+            argv[1:], 'a:dhJmP:',
+            ['apply=', 'diff', 'help', 'journal', 'merge', 'prefer='])
+        for option, value in opts:
+            if option in ('-a', '--apply'):
+                changes_fpath = value
+            if option in ('-d', '--diff'):
+                mode = 'diff'
             if option in ('-h', '--help'):
                 print(USAGE, end='')
                 return 0
-        if len(args) != 1:
+            if option in ('-J', '--journal'):
+                journal = True
+            if option in ('-m', '--merge'):
+                mode = 'merge'
+            if option in ('-P', '--prefer'):
+                if value not in ('first', 'last', 'error'):
+                    raise getopt.GetoptError('invalid preference: ' + value)
+                prefer = value
+        if mode == 'merge' and len(args) > 0:
+            fds_in = [open(fpath, 'r', encoding='utf-8-sig')
+                      for fpath in args]
+            try:
+                count, conflicts = merge_tables(fds_in, sys.stdout, prefer,
+                                                args)
+            finally:
+                for fd_in in fds_in:
+                    fd_in.close()
+            sys.stderr.write('%d rules, %d conflicts\n' % (count, conflicts))
+            return 0
+        if mode == 'diff' and len(args) == 2:
+            with open(args[0], 'r', encoding='utf-8-sig') as fd_old, \
+                    open(args[1], 'r', encoding='utf-8-sig') as fd_new:
+                counts = diff_tables(fd_old, fd_new, sys.stdout)
+            sys.stderr.write('%d added, %d changed, %d removed\n' % (
+                counts['added'], counts['changed'], counts['removed']))
+            return 0
+        if len(args) != 1 or mode is not None:
             sys.stderr.write(USAGE)
             return 1
-        edit(args[0])
+        if changes_fpath is not None:
+            with open(changes_fpath, 'r', encoding='utf-8-sig') as fin:
+                edit(args[0], fin, batch=True)
+        else:
+            edit(args[0], journal=journal)
         return 0
     except getopt.GetoptError:
         sys.stderr.write(USAGE)
         return 1
+    except (OSError, RuntimeError) as err:
+        sys.stderr.write('szu-ed: ' + str(err) + '\n')
+        return 1
     except KeyboardInterrupt:
         print()
         return 1
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2014-2015 the Sanzang authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Sanzang program module for NFC normalization."""
+
+
+import collections
+import unicodedata
+
+
+COUNTS = collections.Counter()
+
+# Characters of combining class 0 that compose with a preceding character,
+# other than Hangul jamo: the second characters of canonical compositions.
+COMPOSE_BACK = frozenset(
+    '\u09be\u09d7\u0b3e\u0b56\u0b57\u0bbe\u0bd7\u0cc2\u0cd5\u0cd6\u0d3e'
+    '\u0d57\u0dcf\u0ddf\u102e\u1b35\U00011127\U0001133e\U00011357'
+    '\U000114b0\U000114ba\U000114bd\U000115af\U00011930')
+
+
+def nfc(text):
+    """
+    Return a text in Normalization Form C, counting any text renormalized.
+
+    Most text is already in NFC. ASCII text is returned at once, and other
+    text is passed to unicodedata.normalize(), which runs a quick check of
+    the text and returns it as it is if the check passes. This is faster
+    than a separate call to unicodedata.is_normalized(). Only if the text
+    is changed are its lines compared, to add the number of lines and UTF-8
+    bytes that were renormalized to COUNTS, as "lines" and "bytes".
+
+    """
+    if text.isascii():
+        return text
+    norm = unicodedata.normalize('NFC', text)
+    if norm is not text and norm != text:
+        for line, norm_line in zip(text.split('\n'), norm.split('\n')):
+            if line != norm_line:
+                COUNTS['lines'] += 1
+                COUNTS['bytes'] += len(line.encode('utf-8', 'surrogatepass'))
+    return norm
+
+
+def nfc_safe(char):
+    """
+    Return True if text may be split before a character for normalization.
+
+    Text split before such a character is normalized in two parts with the
+    same result as normalizing the whole. The character must decompose to
+    a starter (of canonical combining class 0) that never composes with a
+    preceding character, so combining marks, Hangul vowel and final jamo,
+    and vowel signs that compose with their consonant are all excluded.
+
+    """
+    if char < '\u0300':
+        return True
+    first = unicodedata.normalize('NFD', char)[0]
+    return (unicodedata.combining(first) == 0 and
+            not '\u1161' <= first <= '\u1175' and
+            not '\u11a8' <= first <= '\u11c2' and
+            first not in COMPOSE_BACK)
+
+
+def summary():
+    """Return a description of the text renormalized, for verbose output."""
+    return 'renormalized %d bytes in %d lines' % (
+        COUNTS['bytes'], COUNTS['lines'])
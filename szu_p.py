@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2014-2015 the Sanzang authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Sanzang program module for translation pipelines."""
+
+
+import getopt
+import io
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+
+import szu_nfc
+import szu_r
+import szu_ss
+import szu_t
+
+
+USAGE = """Usage: szu-p [options] table_file [file ...]
+
+Reformat, substitute, and translate CJK text in one process.
+
+Options:
+  -c, --cache      load the table through a compiled cache file
+  -e, --engine     matching engine: "replace" (default) or "trie"
+  -h, --help       print this help message and exit
+  -n, --no-reflow  do not reformat the text before substitution
+  -p, --parallel   run substitution and translation in worker processes
+  -s, --subst      make substitutions with a two-column table first
+  -v, --verbose    include information useful for debugging
+
+"""
+
+QUEUE_SIZE = 16
+
+
+def set_stdio_utf8():
+    """
+    Set standard I/O streams to UTF-8.
+
+    Attempt to reassign standard I/O streams to new streams using UTF-8.
+    Standard input should discard any leading BOM. If an error is raised,
+    assume the environment is inflexible but correct (IDLE).
+
+    """
+    try:
+        sys.stdin = io.TextIOWrapper(
+            sys.stdin.detach(), encoding='utf-8-sig', line_buffering=True)
+        sys.stdout = io.TextIOWrapper(
+            sys.stdout.detach(), encoding='utf-8', line_buffering=True)
+        sys.stderr = io.TextIOWrapper(
+            sys.stderr.detach(), encoding='utf-8', line_buffering=True)
+    except io.UnsupportedOperation:
+        pass
+
+
+def iter_lines(chunks):
+    """
+    Split text chunks into lines (generator).
+
+    Each line is yielded with its newline, except for any last line that
+    does not end with a newline. Chunks may be split anywhere, and a line
+    spread over many chunks is only joined once.
+
+    """
+    parts = []
+    for chunk in chunks:
+        lines = chunk.split('\n')
+        if len(lines) > 1:
+            parts.append(lines[0])
+            yield ''.join(parts) + '\n'
+            for line in lines[1:-1]:
+                yield line + '\n'
+            parts = []
+        if lines[-1] != '':
+            parts.append(lines[-1])
+    if len(parts) > 0:
+        yield ''.join(parts)
+
+
+def line_buffers(chunks, buffer_size=1000):
+    """Join lines from text chunks into buffers of lines (generator)."""
+    lines = []
+    for line in iter_lines(chunks):
+        lines.append(line)
+        if len(lines) == buffer_size:
+            yield ''.join(lines)
+            lines = []
+    if len(lines) > 0:
+        yield ''.join(lines)
+
+
+def read_stage(fds_in, buffer_size=1000):
+    """Read normalized text from file objects in turn. Yield text chunks."""
+    for fd_in in fds_in:
+        yield from szu_r.read_chunks(fd_in, buffer_size)
+
+
+def reflow_stage(fds_in, buffer_size=1000):
+    """
+    Reformat CJK text from file objects in turn. Yield text chunks.
+
+    Each file is reformatted separately, as by szu_r.reflow_file(), and
+    the text of one file follows that of the previous one.
+
+    """
+    for fd_in in fds_in:
+        yield from szu_r.reflow_iter(szu_r.read_chunks(fd_in, buffer_size))
+
+
+def subst_stage(chunks, table, options, buffer_size=1000):
+    """
+    Make string substitutions in text chunks. Yield text chunks.
+
+    The text is substituted in buffers of lines with szu_ss.subst(), given
+    the table and a dictionary of any other arguments for it. No source
+    term can span lines, so the result does not depend on the buffers.
+
+    """
+    for buffer in line_buffers(chunks, buffer_size):
+        yield szu_ss.subst(table, buffer, **options)
+
+
+def translate_stage(chunks, table, matcher=None, buf_size=100, memo=None):
+    """
+    Translate text chunks using a table. Yield formatted listings.
+
+    The text is translated in buffers of lines with szu_t.tr_fmt(), with
+    line numbers counted from the beginning of the text.
+
+    """
+    for buffer, start in szu_t.read_buffers(iter_lines(chunks), 1, buf_size):
+        yield szu_t.tr_fmt(table, buffer, start, matcher, memo=memo)
+
+
+def _get(queue_in, parent):
+    """Get an item from a queue, leaving the process if its parent exits."""
+    while True:
+        try:
+            return queue_in.get(timeout=1)
+        except queue.Empty:
+            if os.getppid() != parent:
+                os._exit(1)
+
+
+def _put(queue_out, item, parent):
+    """Put an item on a queue, leaving the process if its parent exits."""
+    while True:
+        try:
+            return queue_out.put(item, timeout=1)
+        except queue.Full:
+            if os.getppid() != parent:
+                os._exit(1)
+
+
+def _receive(queue_in, parent):
+    """Yield text chunks from a queue, and raise any error sent instead."""
+    while True:
+        item = _get(queue_in, parent)
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def _feed(chunks, queue_in):
+    """Put text chunks on a queue, followed by None or by an error."""
+    try:
+        for chunk in chunks:
+            queue_in.put(chunk)
+        queue_in.put(None)
+    except Exception as err:
+        queue_in.put(err)
+
+
+def _stage_worker(stage, args, queue_in, queue_out, parent):
+    """Run a pipeline stage in a worker process, between two queues."""
+    renormalized = szu_nfc.COUNTS.copy()
+    try:
+        for chunk in stage(_receive(queue_in, parent), *args):
+            _put(queue_out, chunk, parent)
+        _put(queue_out, szu_nfc.COUNTS - renormalized, parent)
+    except Exception as err:
+        _put(queue_out, err, parent)
+
+
+def parallel_stage(stage, chunks, *args):
+    """
+    Run a pipeline stage in a worker process. Yield its text chunks.
+
+    The input chunks are sent to the worker from a thread, and the output
+    chunks are returned, through queues of at most QUEUE_SIZE chunks, so
+    the stage runs at the same time as the stages before and after it. An
+    error in the worker or in an earlier stage is raised again here, and
+    the counts of text renormalized by the worker are added to szu_nfc.
+
+    """
+    queue_in = multiprocessing.Queue(QUEUE_SIZE)
+    queue_out = multiprocessing.Queue(QUEUE_SIZE)
+    worker = multiprocessing.Process(
+        target=_stage_worker,
+        args=(stage, args, queue_in, queue_out, os.getpid()), daemon=True)
+    worker.start()
+    threading.Thread(target=_feed, args=(chunks, queue_in),
+                     daemon=True).start()
+    try:
+        while True:
+            try:
+                item = queue_out.get(timeout=1)
+            except queue.Empty:
+                if not worker.is_alive():
+                    raise RuntimeError('Pipeline worker exited: %s' %
+                                       stage.__name__)
+                continue
+            if isinstance(item, str):
+                yield item
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                szu_nfc.COUNTS.update(item)
+                break
+        worker.join()
+    finally:
+        queue_in.cancel_join_thread()
+        if worker.is_alive():
+            worker.terminate()
+
+
+def pipeline(fds_in, fd_out, table, matcher=None, ss_table=None,
+             ss_options=None, reflow=True, parallel=False, memo=None):
+    """
+    Reformat, substitute, and translate text from file objects in turn.
+
+    This is the same as piping the text through szu-r, szu-ss, and szu-t,
+    but the text is passed from one stage to the next as strings in one
+    process, so it is not encoded and decoded again. Reformatting is done
+    if reflow is true, and substitution if a table for it is given, along
+    with a dictionary of any other arguments for szu_ss.subst(). The text
+    is then translated with the table and any matcher and LineMemo. If
+    parallel is true, then substitution and translation are each run in a
+    worker process, with parallel_stage().
+
+    """
+    if reflow:
+        chunks = reflow_stage(fds_in)
+    else:
+        chunks = read_stage(fds_in)
+    if ss_options is None:
+        ss_options = {}
+    if ss_table is not None and parallel:
+        chunks = parallel_stage(subst_stage, chunks, ss_table, ss_options)
+    elif ss_table is not None:
+        chunks = subst_stage(chunks, ss_table, ss_options)
+    if parallel:
+        listings = parallel_stage(translate_stage, chunks, table, matcher,
+                                  100, memo)
+    else:
+        listings = translate_stage(chunks, table, matcher, 100, memo)
+    for listing in listings:
+        fd_out.write(listing)
+
+
+def main(argv):
+    """
+    Run szu-p as a portable command-line program.
+
+    This program handles data through standard I/O streams as UTF-8 text.
+    Input has any leading byte-order mark stripped if one is found. Broken
+    pipes and SIGINT are handled silently.
+
+    """
+    set_stdio_utf8()
+    if 'SIGPIPE' in dir(signal):
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    try:
+        verbose = False
+        cache = False
+        engine = 'replace'
+        reflow = True
+        parallel = False
+        ss_fpath = None
+        opts, args = getopt.getopt(
+            argv[1:], 'ce:hnps:v',
+            ['cache', 'engine=', 'help', 'no-reflow', 'parallel', 'subst=',
+             'verbose'])
+        for option, value in opts:
+            if option in ('-c', '--cache'):
+                cache = True
+            if option in ('-e', '--engine'):
+                if value not in ('replace', 'trie'):
+                    raise RuntimeError('Unknown engine: ' + value)
+                engine = value
+            if option in ('-h', '--help'):
+                print(USAGE, end='')
+                return 0
+            if option in ('-n', '--no-reflow'):
+                reflow = False
+            if option in ('-p', '--parallel'):
+                parallel = True
+            if option in ('-s', '--subst'):
+                ss_fpath = value
+            if option in ('-v', '--verbose'):
+                verbose = True
+        if len(args) < 1:
+            sys.stderr.write(USAGE)
+            return 1
+        ss_table = None
+        ss_options = None
+        if ss_fpath is not None:
+            with open(ss_fpath, 'r', encoding='utf-8-sig') as table_fd:
+                ss_table = szu_ss.read_ss_table(table_fd)
+            ss_options = {'matcher': szu_ss.make_matcher(ss_table),
+                          'cascade': szu_ss.cascade_rules(ss_table),
+                          'runs': szu_ss.char_runs(ss_table),
+                          'steps': szu_ss.rule_steps(ss_table)}
+        table, matcher = szu_t.open_table(args[0], engine, cache)
+        if len(args) == 1:
+            fds_in = [sys.stdin]
+        else:
+            fds_in = szu_t.open_files(args[1:])
+        pipeline(fds_in, sys.stdout, table, matcher, ss_table, ss_options,
+                 reflow, parallel)
+        if verbose:
+            sys.stderr.write('szu-p: ' + szu_nfc.summary() + '\n')
+        return 0
+    except KeyboardInterrupt:
+        print()
+        return 1
+    except Exception as err:
+        if verbose:
+            raise
+        else:
+            sys.stderr.write('szu-p: ' + str(err) + '\n')
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
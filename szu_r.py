@@ -23,11 +23,22 @@
 """Sanzang program module for reformatting CJK text."""
 
 
+import codecs
+import collections
 import getopt
 import io
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
 import signal
+import struct
 import sys
-import unicodedata
+import tempfile
+import time
+
+import szu_nfc
 
 
 USAGE = """Usage: szu-r [options] [file ...]
@@ -36,7 +47,10 @@ Reformat CJK text for translation.
 
 Options:
   -h, --help       print this help message and exit
+  -j, --jobs       number of worker processes for input files (default 1)
+  -o, --output-dir write each input file to a mirrored path in a directory
   -v, --verbose    include information useful for debugging
+  -x, --index      write an index of the CBETA margins of output lines
 
 """
 
@@ -61,6 +75,80 @@ def set_stdio_utf8():
         pass
 
 
+INDEX_MAGIC = b'SZUX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sIQQQ')
+INDEX_RECORD = struct.Struct('<IIQII')
+
+STARTERS = '「『　\t'
+ENDERS = '：，；。？！」』.;:?!'
+SPECIALS = STARTERS + ENDERS + '\x1f'
+
+# A line break goes after an ender that is followed by a non-ender, and
+# before a starter that does not follow another special character.
+BREAK_RE = re.compile('(?<=[%s])(?=[^%s])|(?<=[^%s])(?=[%s])' % (
+    re.escape(ENDERS), re.escape(ENDERS), re.escape(SPECIALS),
+    re.escape(STARTERS)))
+
+
+def reflow_iter(chunks, marks=None):
+    """
+    Reformat CJK text from an iterable of strings. Yield the new text.
+
+    This is the streaming form of reflow(). The input may be split into
+    chunks anywhere, and the state of the reformatting is kept from one
+    chunk to the next, so the output is the same as that of reflow() for
+    the whole text. Each chunk is reformatted a line at a time, and the
+    output for the complete lines in a chunk is yielded as one string.
+
+    If marks is a list, then for each line of output, a (line, margin)
+    tuple is appended to it, giving the index of the input line where the
+    output line begins and the CBETA margin of that input line, if any.
+    The marks for the text are appended before it is yielded.
+
+    """
+    prev_c = '\x1f'
+    line_start = True
+    line_idx = 0
+    partial = ''
+    for chunk in chunks:
+        lines = (partial + chunk).split('\n')
+        partial = lines.pop()
+        out = []
+        for line in lines:
+            margin, text = _reflow_line(line, prev_c)
+            if text != '':
+                out.append(text)
+                prev_c = text[-1]
+                if marks is not None:
+                    count = text.count('\n') + line_start
+                    marks.extend([(line_idx, margin)] * count)
+                line_start = False
+            line_idx += 1
+        if len(out) > 0:
+            yield ''.join(out)
+    margin, text = _reflow_line(partial, prev_c)
+    if text != '':
+        if marks is not None:
+            count = text.count('\n') + line_start
+            marks.extend([(line_idx, margin)] * count)
+        yield text + '\n'
+    elif not line_start:
+        yield '\n'
+
+
+def _reflow_line(line, prev_c):
+    """Reformat one line. Return its margin and the reformatted text."""
+    margin = ''
+    if '║' in line:
+        margin, line = line.split('║', 1)
+    if line.startswith('　') and len(line) < 17:
+        line += '　'
+    if line == '':
+        return margin, ''
+    return margin, BREAK_RE.sub('\n', prev_c + line)[1:]
+
+
 def reflow(text):
     """
     Reformat CJK text according to its punctuation.
@@ -74,57 +162,353 @@ def reflow(text):
     CBETA margin format: X01n0020_p0404a01(00)║
 
     """
-    starters = '「『　\t'
-    enders = '：，；。？！」』.;:?!'
-    specials = starters + enders + '\x1f'
-    new_str = ''
-    prev_c = '\x1f'
-    for line in text.split('\n'):
-        if '║' in line:
-            line = line.split('║', 1)[-1]
-        if line.startswith('　') and len(line) < 17:
-            line += '　'
-        for cur_c in line:
-            if prev_c in enders and cur_c not in enders:
-                new_str += '\n'
-            elif cur_c in starters and prev_c not in specials:
-                new_str += '\n'
-            new_str += cur_c
-            prev_c = cur_c
-    if len(new_str) > 0 and new_str[-1] != '\n':
-        new_str += '\n'
-    return new_str
-
-
-def reflow_file(fd_in, fd_out, buffer_size=1000):
+    return ''.join(reflow_iter([text]))
+
+
+def reflow_file(fd_in, fd_out, buffer_size=1000, index=None, offset=0):
     """
     Reformat CJK text from one file object to another.
 
     Given input and output file objects, reformat CJK text from one to the
-    other according to the punctuation and horizontal spacing. I/O is
-    buffered for higher performance.
+    other according to the punctuation and horizontal spacing. Input is
+    read and normalized in buffers of whole lines, and these are streamed
+    through reflow_iter(), so that memory use does not depend on the size
+    of the file and no state is lost between buffers.
+
+    If an index is given, such as a list or an IndexWriter, then for each
+    line of output, a (line, offset, margin) tuple is appended to it. This
+    gives the number of the input line where the output line begins, the
+    byte offset of that input line in the UTF-8 input file, and its CBETA
+    margin. The offset of the first input line may be given, for instance
+    if the input file begins with a byte-order mark.
 
     """
-    enders = '：，；。？！」』.;:?!'
-    str_buf = ''
-    line_n = 0
+    if index is None:
+        for text in reflow_iter(read_chunks(fd_in, buffer_size)):
+            fd_out.write(text)
+        return
+    offsets = collections.deque()
+    marks = []
+    base = 0
+    for text in reflow_iter(read_chunks(fd_in, buffer_size, offsets, offset),
+                            marks):
+        fd_out.write(text)
+        for line_idx, margin in marks:
+            while base < line_idx:
+                offsets.popleft()
+                base += 1
+            index.append((line_idx + 1, offsets[0], margin))
+        marks.clear()
 
+
+def read_chunks(fd_in, buffer_size=1000, offsets=None, offset=0):
+    """
+    Read NFC-normalized text from a file object in buffers of lines.
+
+    If offsets is a deque or a list, then the UTF-8 byte offset of each
+    line read is appended to it, counting from the given offset. Line
+    endings are translated to "\n", so that the file object may be opened
+    with newline='' to count the offsets of lines as they are in the file.
+
+    """
+    lines = []
     for line in fd_in:
-        line_n += 1
-        str_buf = str_buf + line
-        if line_n % buffer_size == 0:
-            i = len(str_buf) - 1
-            while i > 0:
-                if str_buf[i-1] in enders and str_buf[i] not in enders:
-                    norm_buffer = unicodedata.normalize('NFC', str_buf[:i])
-                    fd_out.write(reflow(norm_buffer))
-                    str_buf = str_buf[i:]
-                    i = -1
-                else:
-                    i = i - 1
-    if len(str_buf) > 0:
-        norm_buffer = unicodedata.normalize('NFC', str_buf)
-        fd_out.write(reflow(norm_buffer))
+        if offsets is not None:
+            offsets.append(offset)
+            offset += len(line.encode('utf-8'))
+        if line.endswith('\r\n'):
+            line = line[:-2] + '\n'
+        elif line.endswith('\r'):
+            line = line[:-1] + '\n'
+        lines.append(line)
+        if len(lines) == buffer_size:
+            yield szu_nfc.nfc(''.join(lines))
+            lines = []
+    if len(lines) > 0:
+        yield szu_nfc.nfc(''.join(lines))
+
+
+def bom_size(file_path):
+    """Return the size in bytes of any UTF-8 byte-order mark in a file."""
+    with open(file_path, 'rb') as fin:
+        return 3 if fin.read(3) == codecs.BOM_UTF8 else 0
+
+
+class IndexWriter:
+    """
+    A writer for a margin index of reformatted text.
+
+    A margin index maps each line of reformatted output to the input file,
+    input line, byte offset, and CBETA margin where the output line begins.
+    The file has a header, a table of fixed-size records (one per output
+    line, in order), the margins as UTF-8 text, and the input file names,
+    one per line. Records are written as they are appended, and margins
+    are spooled to a temporary file, so memory use stays constant.
+
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.fd_out = open(fpath, 'wb')
+        self.fd_out.write(b'\0' * INDEX_HEADER.size)
+        self.margins = tempfile.TemporaryFile()
+        self.margins_size = 0
+        self.names = []
+        self.count = 0
+        self.last = None
+
+    def add_file(self, name):
+        """Begin the records for a new input file."""
+        self.names.append(name)
+        self.last = None
+
+    def append(self, record):
+        """Add a (line, offset, margin) record for the next output line."""
+        line_no, offset, margin = record
+        if self.last is None or self.last[0] != line_no:
+            data = margin.encode('utf-8')
+            self.margins.write(data)
+            self.last = (line_no, self.margins_size, len(data))
+            self.margins_size += len(data)
+        self.fd_out.write(INDEX_RECORD.pack(
+            len(self.names) - 1, line_no, offset, self.last[1],
+            self.last[2]))
+        self.count += 1
+
+    def extend(self, records):
+        """Add records for a sequence of output lines."""
+        for record in records:
+            self.append(record)
+
+    def close(self):
+        """Write the margins, file names, and header, and close the file."""
+        margins_pos = self.fd_out.tell()
+        self.margins.seek(0)
+        shutil.copyfileobj(self.margins, self.fd_out)
+        self.margins.close()
+        names_pos = self.fd_out.tell()
+        self.fd_out.write('\n'.join(self.names).encode('utf-8'))
+        self.fd_out.seek(0)
+        self.fd_out.write(INDEX_HEADER.pack(
+            INDEX_MAGIC, INDEX_VERSION, self.count, margins_pos, names_pos))
+        self.fd_out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MarginIndex:
+    """
+    A memory-mapped margin index written by IndexWriter.
+
+    Output lines are numbered from 1, as in the listings made by szu-t
+    from the reformatted text, so lookup() finds the input position of a
+    listing line directly. find() searches in the other direction, from a
+    position in an input file to the output line, in O(log n) time.
+
+    """
+
+    def __init__(self, fpath):
+        with open(fpath, 'rb') as fin:
+            self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.margins_pos, names_pos = \
+            INDEX_HEADER.unpack_from(self.data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self.data.close()
+            raise RuntimeError('Invalid margin index: ' + fpath)
+        self.names = self.data[names_pos:].decode('utf-8').split('\n')
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, idx):
+        """Return the raw record for a 0-based output line index."""
+        return INDEX_RECORD.unpack_from(
+            self.data, INDEX_HEADER.size + idx * INDEX_RECORD.size)
+
+    def lookup(self, line_no):
+        """
+        Find where an output line begins in the input.
+
+        Return a tuple of the input file name, the input line number, the
+        byte offset of the input line, and its CBETA margin.
+
+        """
+        if line_no < 1 or line_no > self.count:
+            raise IndexError('Output line out of range: %d' % line_no)
+        file_no, src_line, offset, margin_pos, margin_len = \
+            self._record(line_no - 1)
+        pos = self.margins_pos + margin_pos
+        margin = self.data[pos:pos + margin_len].decode('utf-8')
+        return self.names[file_no], src_line, offset, margin
+
+    def find(self, name, offset):
+        """
+        Find the output line for a byte offset in an input file.
+
+        Return the number of the last output line that begins at or before
+        the input line at the offset, or None if there is no such line.
+
+        """
+        if name not in self.names:
+            return None
+        key = (self.names.index(name), offset)
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            record = self._record(mid)
+            if (record[0], record[2]) <= key:
+                low = mid + 1
+            else:
+                high = mid
+        if low == 0 or self._record(low - 1)[0] != key[0]:
+            return None
+        return low
+
+    def close(self):
+        """Close the memory map."""
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def mirror_path(file_path, out_dir):
+    """
+    Return the path in an output directory that mirrors an input path.
+
+    The input path is made relative to the working directory, and this
+    relative path is joined to the output directory. Paths outside of the
+    working directory cannot be mirrored, and raise a RuntimeError.
+
+    """
+    rel_path = os.path.relpath(os.path.abspath(file_path))
+    if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+        raise RuntimeError('Cannot mirror path: ' + file_path)
+    return os.path.join(out_dir, rel_path)
+
+
+def reflow_path(file_path, out_path=None, index=None, fd_out=None):
+    """
+    Reformat one CJK text file. Return (size, seconds).
+
+    The file is read from the given path. If an output path is given, the
+    text is written to this file, creating any missing directories, and
+    otherwise it is written to the output file object. The size of the
+    input file in bytes and the time taken are returned for progress
+    reports. Any index is passed on to reflow_file().
+
+    """
+    start = time.perf_counter()
+    offset = 0 if index is None else bom_size(file_path)
+    with open(file_path, 'r', encoding='utf-8-sig', newline='') as fin:
+        if out_path is None:
+            reflow_file(fin, fd_out, index=index, offset=offset)
+        else:
+            out_dir = os.path.dirname(out_path)
+            if out_dir != '':
+                os.makedirs(out_dir, exist_ok=True)
+            with open(out_path, 'w', encoding='utf-8') as fout:
+                reflow_file(fin, fout, index=index, offset=offset)
+    size = os.path.getsize(file_path)
+    return size, time.perf_counter() - start
+
+
+def _reflow_worker(file_path, out_path, indexed):
+    """Reformat one file in a worker process, with index records if any."""
+    records = [] if indexed else None
+    renormalized = szu_nfc.COUNTS.copy()
+    result = reflow_path(file_path, out_path, records)
+    return result, records, szu_nfc.COUNTS - renormalized
+
+
+def reflow_paths(file_paths, fd_out, jobs=1, out_dir=None, fd_log=None,
+                 index=None):
+    """
+    Reformat a sequence of CJK text files, in parallel if jobs > 1.
+
+    Files are reformatted by a pool of worker processes, and the output is
+    written to fd_out in the original order of the files. Each worker
+    writes its output to a temporary file, which is copied to fd_out in
+    turn, and only a limited number of files are handled ahead of the
+    output. If an output directory is given, then each file is written to
+    its mirrored path under it instead. If a log file object is given,
+    then a line of progress is written to it for each file, followed by a
+    summary of the throughput and of the text renormalized.
+    If an IndexWriter is given, then the records for each file are added
+    to it in order.
+
+    """
+    tasks = [(path, None if out_dir is None else mirror_path(path, out_dir))
+             for path in file_paths]
+    start = time.perf_counter()
+    totals = [0, 0.0]
+    if jobs == 1:
+        for path, out_path in tasks:
+            if index is not None:
+                index.add_file(path)
+            result = reflow_path(path, out_path, index, fd_out)
+            _reflow_done(path, None, (result, None, None), fd_out, fd_log,
+                         totals, index)
+    else:
+        spools = []
+        try:
+            with multiprocessing.Pool(jobs) as pool:
+                pending = collections.deque()
+                for path, out_path in tasks:
+                    spool = None
+                    if out_path is None:
+                        tmp_fd, spool = tempfile.mkstemp(suffix='.tmp')
+                        os.close(tmp_fd)
+                        spools.append(spool)
+                    pending.append((path, spool, pool.apply_async(
+                        _reflow_worker, (path, out_path or spool,
+                                         index is not None))))
+                    if len(pending) >= jobs * 4:
+                        path, spool, result = pending.popleft()
+                        _reflow_done(path, spool, result.get(), fd_out,
+                                     fd_log, totals, index)
+                while len(pending) > 0:
+                    path, spool, result = pending.popleft()
+                    _reflow_done(path, spool, result.get(), fd_out, fd_log,
+                                 totals, index)
+        finally:
+            for spool in spools:
+                if os.path.exists(spool):
+                    os.unlink(spool)
+    if fd_log is not None:
+        elapsed = time.perf_counter() - start
+        fd_log.write('szu-r: %d files, %d bytes in %.3f s (%.2f MB/s), '
+                     '%.3f s of work with %d jobs\n' % (
+                         len(tasks), totals[0], elapsed,
+                         totals[0] / elapsed / 10 ** 6 if elapsed else 0,
+                         totals[1], jobs))
+        fd_log.write('szu-r: ' + szu_nfc.summary() + '\n')
+
+
+def _reflow_done(path, spool, result, fd_out, fd_log, totals, index):
+    """Write the output and progress for one file, and add to the totals."""
+    (size, seconds), records, renormalized = result
+    if renormalized is not None:
+        szu_nfc.COUNTS.update(renormalized)
+    if spool is not None:
+        with open(spool, 'r', encoding='utf-8') as fin:
+            shutil.copyfileobj(fin, fd_out)
+        os.unlink(spool)
+    if records is not None:
+        index.add_file(path)
+        index.extend(records)
+    if fd_log is not None:
+        fd_log.write('szu-r: %s: %d bytes in %.3f s (%.2f MB/s)\n' % (
+            path, size, seconds, size / seconds / 10 ** 6 if seconds else 0))
+    totals[0] += size
+    totals[1] += seconds
 
 
 def main(argv):
@@ -141,19 +525,49 @@ def main(argv):
         signal.signal(signal.SIGPIPE, signal.SIG_DFL)
     try:
         verbose = False
-        opts, args = getopt.getopt(argv[1:], 'hv', ['help', 'verbose'])
-        for option, _ in opts:
+        jobs = 1
+        out_dir = None
+        index_fpath = None
+        opts, args = getopt.getopt(
+            argv[1:], 'hj:o:vx:',
+            ['help', 'index=', 'jobs=', 'output-dir=', 'verbose'])
+        for option, value in opts:
             if option in ('-h', '--help'):
                 print(USAGE, end='')
                 return 0
+            if option in ('-x', '--index'):
+                index_fpath = value
+            if option in ('-j', '--jobs'):
+                if not value.isdigit() or int(value) < 1:
+                    raise RuntimeError('Invalid number of jobs: ' + value)
+                jobs = int(value)
+            if option in ('-o', '--output-dir'):
+                out_dir = value
             if option in ('-v', '--verbose'):
                 verbose = True
-        if len(args) == 0:
-            reflow_file(sys.stdin, sys.stdout)
-        else:
-            for file_path in args:
-                with open(file_path, 'r', encoding='utf-8-sig') as fin:
-                    reflow_file(fin, sys.stdout)
+        if index_fpath is not None and out_dir is not None:
+            raise RuntimeError('--index cannot be used with --output-dir')
+        if len(args) == 0 and out_dir is not None:
+            raise RuntimeError('--output-dir requires input files')
+        index = None if index_fpath is None else IndexWriter(index_fpath)
+        try:
+            if len(args) == 0:
+                if index is not None:
+                    index.add_file('-')
+                    if isinstance(sys.stdin, io.TextIOWrapper):
+                        sys.stdin.reconfigure(newline='')
+                reflow_file(sys.stdin, sys.stdout, index=index)
+            elif (jobs > 1 or out_dir is not None or verbose
+                  or index is not None):
+                reflow_paths(args, sys.stdout, jobs, out_dir,
+                             sys.stderr if verbose else None, index)
+            else:
+                for file_path in args:
+                    with open(file_path, 'r', encoding='utf-8-sig') as fin:
+                        reflow_file(fin, sys.stdout)
+        finally:
+            if index is not None:
+                index.close()
         return 0
     except KeyboardInterrupt:
         print()
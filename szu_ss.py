@@ -23,19 +23,26 @@
 """Sanzang program module for string substitution."""
 
 
+import functools
 import getopt
 import io
 import signal
 import sys
 import unicodedata
 
+import szu_nfc
+import szu_table
+
 
 USAGE = """Usage: szu-ss [options] table_file [file ...]
 
 Table-based string substitution.
 
 Options
+  -c, --case       match case variants without adding them to the table
+  -e, --engine     matching engine: "replace" (default), "compat" or "trie"
   -h, --help       print this help message and exit
+  -l, --max-chars  maximum characters of input read at once
   -v, --verbose    include information useful for debugging
 
 """
@@ -61,67 +68,376 @@ def set_stdio_utf8():
         pass
 
 
-def read_ss_table(table_fd):
+class _LowerMap(dict):
+    """A str.translate() table mapping each character to its lowercase."""
+
+    def __missing__(self, code):
+        lower = chr(code).lower()
+        self[code] = lower if len(lower) == 1 else code
+        return self[code]
+
+
+_LOWER_MAP = _LowerMap()
+
+
+def fold_case(text):
+    """
+    Convert a text to lowercase one character at a time.
+
+    Unlike str.lower(), this never changes the length of the text, and
+    each character is converted regardless of its context, so positions in
+    the result are the same as in the original text.
+
+    """
+    return text.translate(_LOWER_MAP)
+
+
+def case_variants(term1, term2):
+    """
+    Return the substitution rules for a record with its case variants.
+
+    The list begins with the record itself, followed by a lowercase and an
+    uppercase variant if these differ from the original source term.
+
+    """
+    variants = [(term1, term2)]
+    term1_lower = term1.lower()
+    term1_upper = term1.upper()
+    if term1 != term1_lower:
+        variants.append((term1_lower, term2.lower()))
+    if term1 != term1_upper:
+        variants.append((term1_upper, term2.upper()))
+    return variants
+
+
+def read_ss_table(table_fd, variants=True):
     """
     Read a two-column translation table file for substitutions.
 
     Given an open file object, read and return the contents of a two-column
     translation table. If uppercase or lowercase variants of the source
-    term are available, add records for these variants automatically. For a
-    record with more than two columns, a RuntimeError exception is raised.
+    term are available, add records for these variants automatically,
+    unless variants is false, in which case each record is stored once for
+    case-aware matching. The table is returned as a compact szu_table.Table.
+    For a record with more than two columns, a RuntimeError exception is
+    raised.
 
     """
-    tab = []
-    table_str = unicodedata.normalize('NFC', table_fd.read())
+    lines = []
+    table_str = szu_nfc.nfc(table_fd.read())
     for line in table_str.split('\n'):
         rec = line.split('|')
         if len(rec) == 2:
-            tab.append(rec)
-            term1, term2 = rec
-            term1_lower = term1.lower()
-            term1_upper = term1.upper()
-            if term1 != term1_lower:
-                tab.append([term1_lower, term2.lower()])
-            if term1 != term1_upper:
-                tab.append([term1_upper, term2.upper()])
+            if variants:
+                lines.extend('|'.join(var) for var in case_variants(*rec))
+            else:
+                lines.append(line)
         elif line.strip() != '':
             raise RuntimeError('Table error: ' + line.strip())
-    return tab
+    return szu_table.Table.from_lines(lines)
+
+
+def rule_steps(table, case=False):
+    """
+    Return the substitutions made for each table rule, in order.
+
+    Each item is a list of (source, replacement) pairs for one rule. This is
+    just the rule itself, or the rule with its case variants if case is
+    true (for a table read without variants).
+
+    """
+    if case:
+        return [case_variants(*rec) for rec in table]
+    return [[tuple(rec)] for rec in table]
+
+
+def char_runs(table, case=False):
+    """
+    Compile runs of single-character rules into translation maps.
+
+    Replacing one character at a time is a mapping of each character to a
+    string, so consecutive rules with one-character source terms can be
+    applied together with str.translate(), giving the same result as
+    applying them in turn. Return a dictionary that maps the index of each
+    rule in a run of at least two such rules to a (start, end, map) tuple
+    for the run.
+
+    """
+    steps = rule_steps(table, case)
+    runs = {}
+    start = 0
+    while start < len(steps):
+        end = start
+        while end < len(steps) and all(
+                len(term1) == 1 for term1, _ in steps[end]):
+            end += 1
+        if end - start >= 2:
+            char_map = {}
+            for idx in range(end - 1, start - 1, -1):
+                for term1, term2 in reversed(steps[idx]):
+                    char_map[ord(term1)] = ''.join(
+                        char_map.get(ord(char), char) for char in term2)
+            run = (start, end, char_map)
+            for idx in range(start, end):
+                runs[idx] = run
+        start = end + 1
+    return runs
+
+
+def make_matcher(table, case=False):
+    """
+    Compile a substitution table into a matcher for single-pass scanning.
+
+    The matcher is a prefix dictionary (a hashed trie). Every prefix of
+    every source term is a key. The value is the index of the first table
+    rule with that source term, or -1 if the key is only a prefix of some
+    longer term. Empty source terms are ignored. If case is true, then the
+    keys are the source terms of the rules and their case variants passed
+    through fold_case(), and the values are tuples of the indices of all
+    rules with that key, since their case variants must be told apart.
+
+    """
+    matcher = {}
+    for idx, rec in enumerate(table):
+        if case:
+            terms = set(fold_case(term1)
+                        for term1, _ in case_variants(*rec))
+        else:
+            terms = [rec[0]]
+        for term1 in terms:
+            for end in range(1, len(term1)):
+                if term1[:end] not in matcher:
+                    matcher[term1[:end]] = -1
+            if term1 == '':
+                continue
+            if case:
+                rules = matcher.get(term1, -1)
+                matcher[term1] = (rules if rules != -1 else ()) + (idx,)
+            elif matcher.get(term1, -1) == -1:
+                matcher[term1] = idx
+    return matcher
+
+
+def cascade_rules(table, case=False):
+    """
+    Find the rules that may match text made by earlier substitutions.
+
+    A substitution can only make a new match for a later rule if that
+    rule's source term has a character from an earlier replacement term,
+    or if an earlier replacement term is empty, so that text is joined.
+    Rules with empty source terms always match. Return the sorted indices
+    of these rules, which must be checked even if the matcher does not
+    find their source terms in the original text.
+
+    """
+    indices = []
+    chars = set()
+    joined = False
+    for idx, steps in enumerate(rule_steps(table, case)):
+        for term1, term2 in steps:
+            if joined or term1 == '' or not chars.isdisjoint(term1):
+                if not indices or indices[-1] != idx:
+                    indices.append(idx)
+            chars.update(term2)
+            joined = joined or term2 == ''
+    return indices
+
+
+def find_terms(matcher, text):
+    """
+    Find source terms in a text. Return (rule, start, end) tuples.
+
+    The text is scanned once, and every occurrence of every source term is
+    returned, including occurrences that overlap each other. For a matcher
+    that is case-aware, the text should be passed through fold_case().
+
+    """
+    found = []
+    length = len(text)
+    for start in range(length):
+        end = start + 1
+        idx = matcher.get(text[start])
+        while idx is not None:
+            if isinstance(idx, tuple):
+                found.extend((rule, start, end) for rule in idx)
+            elif idx >= 0:
+                found.append((idx, start, end))
+            end += 1
+            if end > length:
+                break
+            idx = matcher.get(text[start:end])
+    return found
 
 
-def subst(table, text):
+def match_terms(table, matcher, text, case=False, steps=None):
+    """
+    Find source terms in a text. Return (start, end, replacement) tuples.
+
+    Occurrences of source terms are accepted in table order, skipping any
+    that overlap a previously accepted one. This gives the same matches as
+    replacing each term in turn, except that replacement terms are never
+    matched again. If case is true, then the text is matched without
+    regard to case, and each occurrence is accepted as the first case
+    variant of its rule that it is equal to, if any. The case variants of
+    each rule may be given as steps from rule_steps(). The result is sorted
+    by the starting position of each match.
+
+    """
+    if case:
+        found = []
+        for idx, start, end in find_terms(matcher, fold_case(text)):
+            term = text[start:end]
+            if steps is not None:
+                variants = steps[idx]
+            else:
+                variants = case_variants(*table[idx])
+            for var_no, (term1, term2) in enumerate(variants):
+                if term == term1:
+                    found.append((idx, var_no, start, end, term2))
+                    break
+    else:
+        found = [(idx, 0, start, end, table[idx][1])
+                 for idx, start, end in find_terms(matcher, text)]
+    found.sort()
+    taken = bytearray(len(text))
+    spans = []
+    for _, _, start, end, term2 in found:
+        if taken.find(1, start, end) == -1:
+            taken[start:end] = b'\x01' * (end - start)
+            spans.append((start, end, term2))
+    spans.sort()
+    return spans
+
+
+def subst(table, text, matcher=None, cascade=None, runs=None, case=False,
+          steps=None):
     """
     Make string substitutions using a two-column table.
 
     The table specified should already contain any uppercase and lowercase
-    variants that should be applied for substitution.
+    variants that should be applied for substitution, unless case is true,
+    in which case these variants are derived from each rule as needed.
+    Without a matcher, each rule replaces its source term in turn, so that
+    replacements may cascade into matches for later rules. With a matcher,
+    the text is scanned once and no replacement is matched again. If the
+    cascade rules are also given, then the matcher only selects the rules
+    to apply in turn, which gives the same result as having no matcher at
+    all. Runs of single-character rules from char_runs() are applied with
+    one call to str.translate() when replacing terms in turn. The steps
+    from rule_steps() may be given so that they are not derived from the
+    table again for each call.
 
     """
-    text = unicodedata.normalize('NFC', text)
-    for term1, term2 in table:
-        if term1 in text:
-            text = text.replace(term1, term2)
+    text = szu_nfc.nfc(text)
+    if matcher is not None and cascade is None:
+        parts = []
+        pos = 0
+        for start, end, term2 in match_terms(table, matcher, text, case,
+                                             steps):
+            parts.append(text[pos:start])
+            parts.append(term2)
+            pos = end
+        parts.append(text[pos:])
+        return ''.join(parts)
+    if matcher is None:
+        indices = range(len(table))
+    else:
+        indices = set(cascade)
+        if case:
+            found = find_terms(matcher, fold_case(text))
+        else:
+            found = find_terms(matcher, text)
+        indices.update(idx for idx, _, _ in found)
+        indices = sorted(indices)
+    skip = 0
+    for idx in indices:
+        if idx < skip:
+            continue
+        if runs is not None and idx in runs:
+            _, skip, char_map = runs[idx]
+            text = text.translate(char_map)
+            continue
+        if steps is not None:
+            rule = steps[idx]
+        elif case:
+            rule = case_variants(*table[idx])
+        else:
+            rule = [table[idx]]
+        for term1, term2 in rule:
+            if term1 in text:
+                text = text.replace(term1, term2)
     return text
 
 
-def subst_file(table, fd_in, fd_out, buffer_size=1000):
+def safe_split(chars, text, start=0):
+    """
+    Find the last position where text can be split for substitutions.
+
+    A position is safe if normalization cannot join characters across it,
+    and if the character before it, which is then left as it is by the
+    normalization of the text before the position, is not in the set of
+    characters found in source terms, since no term can then match across
+    the position. Positions up to start are not checked. The position is
+    returned, or 0 if there is no safe position.
+
+    """
+    pos = len(text) - 1
+    while pos > max(start, 0):
+        if (szu_nfc.nfc_safe(text[pos]) and szu_nfc.nfc_safe(text[pos - 1])
+                and chars.isdisjoint(
+                    unicodedata.normalize('NFC', text[pos - 1]))):
+            return pos
+        pos -= 1
+    return 0
+
+
+def subst_file(table, fd_in, fd_out, buffer_size=1000, max_chars=None,
+               matcher=None, cascade=None, runs=None, case=False, steps=None):
     """
     Make string substitutions from file to file (buffered).
 
     Given the contents of a two-column translation table, along with input
     and output file objects, make one-to-one string substitutions using
-    buffered I/O.
+    buffered I/O. If max_chars is given, then at most max_chars characters
+    are read at a time, and a buffer that grows longer than this is split
+    at the last safe position, so that very long lines can be handled in
+    bounded memory. The output is the same as that for unbounded buffers.
+    Any matcher, cascade rules, runs, case setting, and steps are passed on
+    to subst(). If the steps are not given, then they are derived once for
+    the whole file, so that table rules are not split again for each buffer.
 
     """
+    if steps is None:
+        steps = rule_steps(table, case)
+    if max_chars is not None:
+        chars = set()
+        for rule in steps:
+            chars.update(''.join(term1 for term1, _ in rule))
+        read_line = functools.partial(fd_in.readline, max_chars)
+    else:
+        read_line = fd_in.readline
     str_buf = ''
+    checked = 0
     line_no = 1
-    for line in fd_in:
+    line = read_line()
+    while line != '':
         str_buf += line
-        if line_no % buffer_size == 0:
-            fd_out.write(subst(table, str_buf))
-            str_buf = ''
-        line_no += 1
-    fd_out.write(subst(table, str_buf))
+        if line.endswith('\n'):
+            if line_no % buffer_size == 0:
+                fd_out.write(subst(table, str_buf, matcher, cascade, runs,
+                                   case, steps))
+                str_buf = ''
+                checked = 0
+            line_no += 1
+        if max_chars is not None and len(str_buf) >= max_chars:
+            split = safe_split(chars, str_buf, checked)
+            if split > 0:
+                fd_out.write(subst(table, str_buf[:split], matcher,
+                                   cascade, runs, case, steps))
+                str_buf = str_buf[split:]
+            checked = len(str_buf) - 1
+        line = read_line()
+    fd_out.write(subst(table, str_buf, matcher, cascade, runs, case, steps))
 
 
 def main(argv):
@@ -138,27 +454,53 @@ def main(argv):
         signal.signal(signal.SIGPIPE, signal.SIG_DFL)
     try:
         verbose = False
-        opts, args = getopt.getopt(argv[1:], 'hv', ['help', 'verbose'])
-        for option, _ in opts:
+        case = False
+        engine = 'replace'
+        max_chars = None
+        opts, args = getopt.getopt(
+            argv[1:], 'ce:hl:v',
+            ['case', 'engine=', 'help', 'max-chars=', 'verbose'])
+        for option, value in opts:
+            if option in ('-c', '--case'):
+                case = True
+            if option in ('-e', '--engine'):
+                if value not in ('replace', 'compat', 'trie'):
+                    raise RuntimeError('Unknown engine: ' + value)
+                engine = value
             if option in ('-h', '--help'):
                 print(USAGE, end='')
                 return 0
+            if option in ('-l', '--max-chars'):
+                if not value.isdigit() or int(value) < 1:
+                    raise RuntimeError('Invalid character limit: ' + value)
+                max_chars = int(value)
             if option in ('-v', '--verbose'):
                 verbose = True
         if len(args) < 1:
             sys.stderr.write(USAGE)
             return 1
         with open(args[0], encoding='utf-8-sig') as table_fd:
-            table = read_ss_table(table_fd)
+            table = read_ss_table(table_fd, variants=not case)
+        options = {'max_chars': max_chars, 'case': case,
+                   'steps': rule_steps(table, case)}
+        if engine != 'replace':
+            options['matcher'] = make_matcher(table, case)
+        if engine == 'compat':
+            options['cascade'] = cascade_rules(table, case)
+        if engine != 'trie':
+            options['runs'] = char_runs(table, case)
         if len(args) == 1:
             if sys.stdin.isatty():
-                subst_file(table, sys.stdin, sys.stdout, buffer_size=1)
+                subst_file(table, sys.stdin, sys.stdout, buffer_size=1,
+                           **options)
             else:
-                subst_file(table, sys.stdin, sys.stdout)
+                subst_file(table, sys.stdin, sys.stdout, **options)
         else:
             for file_path in args[1:]:
                 with open(file_path, 'r', encoding='utf-8-sig') as fin:
-                    subst_file(table, fin, sys.stdout)
+                    subst_file(table, fin, sys.stdout, **options)
+        if verbose:
+            sys.stderr.write('szu-ss: ' + szu_nfc.summary() + '\n')
         return 0
     except KeyboardInterrupt:
         print()
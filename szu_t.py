@@ -23,23 +23,57 @@
 """Sanzang program module for CJK translation."""
 
 
+import collections
 import getopt
+import hashlib
 import io
+import json
+import marshal
+import mmap
+import multiprocessing
+import os
+import shutil
 import signal
+import socketserver
+import stat
+import struct
 import sys
-import unicodedata
+import tempfile
+import threading
+
+import szu_nfc
+import szu_table
 
 
 USAGE = """Usage: szu-t [options] table_file [file ...]
+       szu-t [options] --serve=socket table_file
+       szu-t [options] --update=listing --old-table=old_table table_file
 
 Translate CJK text using a translation table.
 
 Options:
+  -c, --cache      load the table through a compiled cache file
+  -e, --engine     matching engine: "replace" (default) or "trie"
   -h, --help       print this help message and exit
+  -j, --jobs       number of worker processes (default 1)
+  -l, --max-chars  maximum characters of input read at once (trie engine)
+  -m, --memo       size of the translated line cache (trie engine only)
+  -M, --memo-file  keep the translated line cache in a file between runs
+  -p, --prune      write a table of only the rules used to a file
+  -s, --serve      serve translations on a Unix socket ("-" for stdio)
+  -S, --stats      write hit counts for the rules used to a file
+  -T, --old-table  the table used for the listing to update
+  -u, --update     update a listing after table changes
   -v, --verbose    include information useful for debugging
 
 """
 
+CACHE_MAGIC = b'SZUT'
+CACHE_VERSION = 3
+CACHE_HEADER = struct.Struct('<4sIIQqI')
+
+_WORKER = {}
+
 
 def set_stdio_utf8():
     """
@@ -66,47 +100,393 @@ def read_table(table_fd):
     Read a translation table from an opened file.
 
     Given an open file object, read a well-formatted translation table and
-    return its contents to the caller.
+    return its contents to the caller, as a compact szu_table.Table.
+
+    """
+    table_str = szu_nfc.nfc(table_fd.read())
+    return szu_table.Table.from_lines(
+        stripped for stripped in (line.strip() for line in
+                                  table_str.split('\n')) if stripped != '')
+
+
+def cache_dir():
+    """
+    Return the default directory for compiled table cache files.
+
+    This is a "sanzang" directory under $XDG_CACHE_HOME if that variable is
+    set, or under ~/.cache otherwise.
+
+    """
+    base = os.environ.get('XDG_CACHE_HOME', '')
+    if base == '':
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'sanzang')
+
+
+def read_cache(cache_fpath, header):
+    """
+    Read an object from a compiled cache file, or return None.
+
+    The cache file is memory-mapped, and its object is only unmarshalled
+    if the file begins with the given header. None is returned if the file
+    is missing, stale, or unreadable.
+
+    """
+    try:
+        with open(cache_fpath, 'rb') as fin:
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(header)] == header:
+                    with memoryview(mm) as view:
+                        return marshal.loads(view[len(header):])
+    except (OSError, ValueError, EOFError, TypeError):
+        pass
+    return None
+
+
+def write_cache(cache_fpath, header, obj):
+    """
+    Write an object to a compiled cache file, replacing it atomically.
+
+    Errors are ignored, since the cache is only used to save time.
+
+    """
+    cache_path = os.path.dirname(cache_fpath)
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        tmp_fd, tmp_fpath = tempfile.mkstemp(dir=cache_path, suffix='.tmp')
+        try:
+            with os.fdopen(tmp_fd, 'wb') as fout:
+                fout.write(header)
+                fout.write(marshal.dumps(obj))
+            os.replace(tmp_fpath, cache_fpath)
+        except BaseException:
+            os.unlink(tmp_fpath)
+            raise
+    except OSError:
+        pass
+
+
+def load_table(table_fpath, cache_path=None, with_matcher=True):
+    """
+    Load a translation table and its matcher, using compiled cache files.
+
+    The parsed table and its matcher are kept in two compiled cache files,
+    so that the matcher is only built and loaded if it is needed. Each file
+    has a header recording the path, size, and modification time of the
+    table file. If a cache file is missing or stale, then it is compiled
+    again and replaced atomically. A valid cache file is memory-mapped and
+    loaded without parsing the table text. If no cache directory is given,
+    then the default cache directory is used. If with_matcher is false,
+    then the matcher returned is None.
+
+    """
+    if cache_path is None:
+        cache_path = cache_dir()
+    table_fpath = os.path.abspath(table_fpath)
+    path_bytes = table_fpath.encode('utf-8', 'surrogateescape')
+    table_stat = os.stat(table_fpath)
+    header = CACHE_HEADER.pack(
+        CACHE_MAGIC, CACHE_VERSION, marshal.version, table_stat.st_size,
+        table_stat.st_mtime_ns, len(path_bytes)) + path_bytes
+    cache_base = os.path.join(cache_path, hashlib.sha1(path_bytes).hexdigest())
+    state = read_cache(cache_base + '.szc', header)
+    if state is not None:
+        table = szu_table.Table.from_state(state)
+    else:
+        with open(table_fpath, 'r', encoding='utf-8-sig') as table_fd:
+            table = read_table(table_fd)
+        write_cache(cache_base + '.szc', header, table.state())
+    if not with_matcher:
+        return table, None
+    matcher = read_cache(cache_base + '.szm', header)
+    if matcher is None:
+        matcher = make_matcher(table)
+        write_cache(cache_base + '.szm', header, matcher)
+    return table, matcher
+
+
+def open_table(table_fpath, engine='replace', cache=False):
+    """
+    Open a translation table file. Return the table and its matcher.
+
+    The matcher is None unless the "trie" engine is selected. If caching
+    is enabled, then the table is loaded through a compiled cache file.
 
     """
-    table_str = unicodedata.normalize('NFC', table_fd.read())
-    table = []
-    for line in table_str.split('\n'):
-        stripped = line.strip()
-        if stripped != '':
-            table.append(stripped.split('|'))
-    return table
+    if cache:
+        return load_table(table_fpath, with_matcher=engine == 'trie')
+    with open(table_fpath, 'r', encoding='utf-8-sig') as table_fd:
+        table = read_table(table_fd)
+    matcher = make_matcher(table) if engine == 'trie' else None
+    return table, matcher
 
 
-def vocab(table, text):
+def vocab(table, text, stats=None):
     """
     Return a new table containing only the vocabulary in the source text.
 
     Create a new translation table containing only the rules that are
     relevant for the given text. This is created by checking all source
-    terms against a copy of the text.
+    terms against a copy of the text, and only the rules that match are
+    split into fields. If a Counter is given for stats, then the number of
+    matches for each source term is added to it.
 
     """
     text_rules = []
     text_copy = str(text)
-    for rec in table:
-        if rec[0] in text_copy:
-            text_copy = text_copy.replace(rec[0], '\x1f')
-            text_rules.append(rec)
+    for idx, term in enumerate(table.terms()):
+        if term in text_copy:
+            if stats is not None:
+                stats[term] += text_copy.count(term)
+            text_copy = text_copy.replace(term, '\x1f')
+            text_rules.append(table[idx])
     return text_rules
 
 
-def tr_raw(table, text):
+def make_matcher(table):
+    """
+    Compile a translation table into a matcher for single-pass scanning.
+
+    The matcher is a prefix dictionary (a hashed trie). Every prefix of
+    every source term is a key. The value is the index of the first table
+    rule with that source term, or -1 if the key is only a prefix of some
+    longer term. Empty source terms are ignored.
+
+    """
+    matcher = {}
+    for idx, rec in enumerate(table):
+        term = rec[0]
+        for end in range(1, len(term)):
+            if term[:end] not in matcher:
+                matcher[term[:end]] = -1
+        if term != '' and matcher.get(term, -1) == -1:
+            matcher[term] = idx
+    return matcher
+
+
+def match_terms(matcher, text):
+    """
+    Find source terms in a text. Return (start, end, rule) tuples.
+
+    The text is scanned once to find every occurrence of every source term.
+    Occurrences are then accepted in table order, skipping any that overlap
+    a previously accepted one. This gives the same matches as vocab(), in
+    which each rule replaces its term in turn. The result is sorted by the
+    starting position of each match.
+
+    """
+    found = []
+    length = len(text)
+    for start in range(length):
+        end = start + 1
+        idx = matcher.get(text[start])
+        while idx is not None:
+            if idx >= 0:
+                found.append((idx, start, end))
+            end += 1
+            if end > length:
+                break
+            idx = matcher.get(text[start:end])
+    found.sort()
+    taken = bytearray(length)
+    spans = []
+    for idx, start, end in found:
+        if taken.find(1, start, end) == -1:
+            taken[start:end] = b'\x01' * (end - start)
+            spans.append((start, end, idx))
+    spans.sort()
+    return spans
+
+
+def tokenize(table, matcher, text, stats=None):
+    """
+    Split a text into segments of unmatched text and matched rules.
+
+    Scan the text once with a matcher, and return a list of segments that
+    together cover the whole text. Each segment is either a string of text
+    that matched no rule, or the table record of a matched source term. If
+    a Counter is given for stats, then each match is counted in it.
+
+    """
+    segments = []
+    pos = 0
+    for start, end, idx in match_terms(matcher, text):
+        if start > pos:
+            segments.append(text[pos:start])
+        segments.append(table[idx])
+        if stats is not None:
+            stats[table[idx][0]] += 1
+        pos = end
+    if pos < len(text):
+        segments.append(text[pos:])
+    return segments
+
+
+def render(segments, col_no):
+    """
+    Render one column of a translation from a list of text segments.
+
+    Matched terms are replaced with the term in the given table column, and
+    separated from the surrounding text by spaces. Column 0 is the source
+    text itself, which is returned unchanged.
+
+    """
+    if col_no == 0:
+        return ''.join(s if isinstance(s, str) else s[0] for s in segments)
+    trans = ''.join(
+        s if isinstance(s, str) else '\x1f' + s[col_no] + '\x1f'
+        for s in segments)
+    trans = trans.replace('\x1f\n', '\n')
+    trans = trans.replace('\x1f\x1f', ' ')
+    return trans.replace('\x1f', ' ')
+
+
+class LineMemo:
+    """
+    A bounded LRU cache of translated lines for one translation table.
+
+    Each source line, including its newline if it has one, is mapped to the
+    rendered text of each table column and the source terms matched in the
+    line. Lines are translated independently of each other by the trie
+    engine, so the cached columns are identical to a fresh translation.
+    The key identifies the table, so that a saved cache is only loaded for
+    the same version of the same table. A pickled copy, as sent to worker
+    processes, has the cached lines but a new lock.
+
+    """
+
+    def __init__(self, maxsize, key=None):
+        self.maxsize = maxsize
+        self.key = key
+        self.lines = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(self, line):
+        """Return the cached value for a line, or None if not cached."""
+        with self.lock:
+            value = self.lines.get(line)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.lines.move_to_end(line)
+            return value
+
+    def put(self, line, value):
+        """Add a value for a line, discarding the least recent if full."""
+        with self.lock:
+            self.lines[line] = value
+            if len(self.lines) > self.maxsize:
+                self.lines.popitem(last=False)
+
+    def hit_rate(self):
+        """Return the fraction of lookups that were cache hits."""
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def load(self, fpath):
+        """Load cached lines from a file, if it exists for this table."""
+        try:
+            with open(fpath, 'rb') as fin:
+                key, items = marshal.load(fin)
+        except (OSError, ValueError, EOFError, TypeError):
+            return
+        if key == self.key:
+            with self.lock:
+                for line, value in items[-self.maxsize:]:
+                    self.lines[line] = value
+
+    def save(self, fpath):
+        """Save cached lines to a file, replacing it atomically."""
+        with self.lock:
+            data = marshal.dumps((self.key, list(self.lines.items())))
+        tmp_fd, tmp_fpath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(fpath)), suffix='.tmp')
+        try:
+            with os.fdopen(tmp_fd, 'wb') as fout:
+                fout.write(data)
+            os.replace(tmp_fpath, fpath)
+        except BaseException:
+            os.unlink(tmp_fpath)
+            raise
+
+
+def table_key(table_fpath):
+    """Return a key for a table file from its path, size, and mtime."""
+    table_stat = os.stat(table_fpath)
+    return (os.path.abspath(table_fpath), table_stat.st_size,
+            table_stat.st_mtime_ns)
+
+
+def tr_line(table, matcher, line, stats=None, memo=None):
+    """
+    Translate one line of text with a matcher. Return rendered columns.
+
+    The line should be normalized, and it may end with a newline. Columns
+    are rendered as by render(), and they are returned as a tuple with one
+    string for each table column. If a memo is given, then the translation
+    is looked up in it before the line is scanned, and added to it after.
+
+    """
+    value = memo.get(line) if memo is not None else None
+    if value is None:
+        segments = tokenize(table, matcher, line)
+        columns = tuple(render(segments, i) for i in range(0, len(table[0])))
+        terms = tuple(s[0] for s in segments if not isinstance(s, str))
+        value = columns, terms
+        if memo is not None:
+            memo.put(line, value)
+    if stats is not None:
+        stats.update(value[1])
+    return value[0]
+
+
+def _tr_columns(table, text, matcher, stats, memo):
+    """Translate normalized text with a matcher, one line at a time."""
+    columns = [[] for _ in range(0, len(table[0]))]
+    pieces = text.split('\n')
+    for i, piece in enumerate(pieces):
+        if i < len(pieces) - 1:
+            piece += '\n'
+        elif piece == '':
+            break
+        for col_idx, trans in enumerate(
+                tr_line(table, matcher, piece, stats, memo)):
+            columns[col_idx].append(trans)
+    return [''.join(col) for col in columns]
+
+
+def tr_raw(table, text, matcher=None, stats=None, memo=None):
     """
     Translate text using a table. Return raw texts in a list.
 
     Perform translation of a text by applying the rules in a translation
     table. The result is a list of strings with each element corresponding
-    to a column in the translation table.
+    to a column in the translation table. If a matcher is given, then the
+    text is segmented with a single scan, and all of the columns are then
+    rendered from these segments. If a Counter is given for stats, then the
+    number of matches for each source term is added to it. If a LineMemo
+    is also given, then lines are translated through this cache.
 
     """
-    text = unicodedata.normalize('NFC', text).replace('\x1f', '')
-    rules = vocab(table, text)
+    text = szu_nfc.nfc(text).replace('\x1f', '')
+    if memo is not None and matcher is not None:
+        return _tr_columns(table, text, matcher, stats, memo)
+    if matcher is not None:
+        segments = tokenize(table, matcher, text, stats)
+        return [render(segments, i) for i in range(0, len(table[0]))]
+    rules = vocab(table, text, stats)
     collection = [text]
     for col_no in range(1, len(table[0])):
         trans = text
@@ -119,53 +499,709 @@ def tr_raw(table, text):
     return collection
 
 
-def tr_fmt(table, buffer, start):
+def tr_iter(table, buffer, start, matcher=None, stats=None, memo=None,
+            strip=True):
     """
-    Translate text using a table. Return a formatted listing string.
+    Translate text using a table. Yield formatted listing records.
 
     Perform translation of a text by applying rules in a translation table,
-    and return a formatted string. The formatted string represents the
-    source text and its translations collated together and organized by
-    line number and by translation table column number.
+    and yield the records of the formatted listing one at a time. Each line
+    of the source text yields one record for each translation table column,
+    followed by an empty line. If a matcher is given, then the listing is
+    formatted directly from text segments, or from the LineMemo cache if
+    one is given. Trailing whitespace at the end of the buffer is removed
+    unless strip is false, which is used when a buffer is followed by more
+    lines that would otherwise have been in the same buffer.
 
     """
-    collection = tr_raw(table, buffer)
+    if matcher is None:
+        collection = tr_raw(table, buffer, stats=stats)
+    elif memo is not None:
+        text = szu_nfc.nfc(buffer).replace('\x1f', '')
+        collection = _tr_columns(table, text, matcher, stats, memo)
+    else:
+        text = szu_nfc.nfc(buffer).replace('\x1f', '')
+        segments = tokenize(table, matcher, text, stats)
+        collection = [render(segments, i) for i in range(0, len(table[0]))]
     for i in range(0, len(collection)):
-        collection[i] = collection[i].rstrip().split('\n')
-    listing = ''
+        if strip:
+            collection[i] = collection[i].rstrip()
+        elif collection[i].endswith('\n'):
+            collection[i] = collection[i][:-1]
+        collection[i] = collection[i].split('\n')
     for line_no in range(0, len(collection[0])):
         for col_idx in range(0, len(table[0])):
-            listing += '%d.%d|%s\n' % (
+            yield '%d.%d|%s\n' % (
                 start + line_no,
                 col_idx + 1,
                 collection[col_idx][line_no])
-        listing += '\n'
-    return listing
+        yield '\n'
 
 
-def tr_file(table, fd_in, fd_out, start_idx=1, buf_size=100):
+def tr_fmt(table, buffer, start, matcher=None, stats=None, memo=None):
     """
-    Translate from one file to another (buffered).
+    Translate text using a table. Return a formatted listing string.
 
-    Given a table, an input file object, and an output file object, apply
-    the translation table rules to the input text and write the translation
-    as a formatted string to the output.
+    Perform translation of a text by applying rules in a translation table,
+    and return a formatted string. The formatted string represents the
+    source text and its translations collated together and organized by
+    line number and by translation table column number.
+
+    """
+    return ''.join(tr_iter(table, buffer, start, matcher, stats, memo))
+
+
+def tr_write(table, buffer, start, fd_out, matcher=None, stats=None,
+             memo=None, strip=True, batch_size=512):
+    """
+    Translate text using a table. Write the listing to a file object.
+
+    Perform translation of a text by applying rules in a translation table,
+    and write the formatted listing to an output file object. Records are
+    written in batches, without building the whole listing in memory.
+
+    """
+    batch = []
+    for record in tr_iter(
+            table, buffer, start, matcher, stats, memo, strip):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            fd_out.write(''.join(batch))
+            batch = []
+    if len(batch) > 0:
+        fd_out.write(''.join(batch))
+
+
+def read_buffers(fd_in, start_idx=1, buf_size=100):
+    """
+    Read lines of text from a file object into buffers (generator).
+
+    Given an input file object, yield (buffer, start) pairs, where start is
+    the line number of the first line in the buffer. Buffers end on lines
+    numbered with a multiple of the buffer size, as counted from start_idx.
 
     """
     str_buf = ''
+    start = start_idx
     line_no = start_idx
     for line in fd_in:
         str_buf += line
         if line_no % buf_size == 0:
-            fd_out.write(tr_fmt(table, str_buf, line_no - buf_size + 1))
+            yield str_buf, start
             str_buf = ''
+            start = line_no + 1
         line_no += 1
     if len(str_buf) > 0:
-        position = line_no - str_buf.count('\n')
-        fd_out.write(tr_fmt(table, str_buf, position))
+        yield str_buf, start
+
+
+def next_line_no(buffer, start):
+    """Return the line number that follows a buffer of lines."""
+    line_no = start + buffer.count('\n')
+    if not buffer.endswith('\n'):
+        line_no += 1
+    return line_no
+
+
+def safe_split(matcher, max_len, text, end, limit):
+    """
+    Find a position at or before end where a text can be split safely.
+
+    A position is safe if no occurrence of any source term crosses it, and
+    if the text may be normalized separately on both sides. Matches are
+    then the same whether the parts are translated separately or together.
+    The text must extend at least max_len characters past end, where
+    max_len is the length of the longest source term. At most limit
+    positions are checked, and -1 is returned if none of them is safe.
+
+    """
+    for pos in range(end, max(0, end - limit), -1):
+        if not szu_nfc.nfc_safe(text[pos]):
+            continue
+        crossed = False
+        for start in range(max(0, pos - max_len + 1), pos):
+            stop = start + 1
+            idx = matcher.get(text[start])
+            while idx is not None and not crossed and stop <= len(text):
+                crossed = idx >= 0 and stop > pos
+                stop += 1
+                idx = matcher.get(text[start:stop])
+            if crossed:
+                break
+        if not crossed:
+            return pos
+    return -1
+
+
+class _RstripWriter:
+    """A file writer that holds back whitespace at the end of its output."""
+
+    def __init__(self, fd_out):
+        self.fd_out = fd_out
+        self.pending = ''
+
+    def write(self, text):
+        stripped = text.rstrip()
+        if stripped == '':
+            self.pending += text
+        else:
+            self.fd_out.write(self.pending + stripped)
+            self.pending = text[len(stripped):]
+
+    def close(self, strip):
+        """Drop the held whitespace if strip is true, or else the newline."""
+        if not strip:
+            self.fd_out.write(self.pending.rstrip('\n'))
+        self.pending = ''
+
+
+def tr_long_line(table, matcher, line, fd_in, fd_out, line_no, max_chars,
+                 stats=None, lines_left=0):
+    """
+    Translate one very long line of text with bounded memory.
+
+    The beginning of the line has already been read, and the rest of it is
+    read from the input file object in pieces of up to max_chars. Pieces
+    are split at safe positions, normalized, and translated separately.
+    The source column is written straight to the output, while the other
+    columns are kept in temporary files until the whole line is done.
+    Trailing whitespace is removed as at the end of a buffer unless a line
+    with other text follows within the next lines_left lines. These lines
+    are read ahead to check for this, and a (pieces, skipped) pair is then
+    returned: the pieces read that the caller should translate next, or
+    else the number of lines of whitespace that were skipped.
+
+    """
+    max_len = max((len(key) for key in matcher), default=1)
+    width = len(table[0])
+    spools = [tempfile.TemporaryFile('w+', encoding='utf-8')
+              for _ in range(1, width)]
+    writers = [_RstripWriter(fd_out)]
+    writers += [_RstripWriter(spool) for spool in spools]
+    carry = [''] * width
+    fd_out.write('%d.1|' % line_no)
+    raw = line
+    norm = ''
+    done = False
+    try:
+        while True:
+            split = len(raw)
+            if not done:
+                split -= 1
+                while split > 0 and not szu_nfc.nfc_safe(raw[split]):
+                    split -= 1
+            if split > 0:
+                norm += szu_nfc.nfc(raw[:split]).replace(
+                    '\x1f', '')
+                raw = raw[split:]
+            final = done and raw == ''
+            if final:
+                split = len(norm)
+            else:
+                split = safe_split(matcher, max_len, norm,
+                                   len(norm) - max_len, max_chars)
+            if split > 0:
+                segments = tokenize(table, matcher, norm[:split], stats)
+                norm = norm[split:]
+                writers[0].write(render(segments, 0))
+                for col_no in range(1, width):
+                    trans = carry[col_no] + ''.join(
+                        s if isinstance(s, str) else
+                        '\x1f' + s[col_no] + '\x1f' for s in segments)
+                    if not final:
+                        stripped = trans.rstrip('\x1f')
+                        carry[col_no] = trans[len(stripped):]
+                        trans = stripped
+                    trans = trans.replace('\x1f\n', '\n')
+                    trans = trans.replace('\x1f\x1f', ' ')
+                    writers[col_no].write(trans.replace('\x1f', ' '))
+            if final:
+                break
+            piece = fd_in.readline(max_chars)
+            raw += piece
+            done = piece == '' or piece.endswith('\n')
+        ahead = []
+        strip = True
+        while lines_left > 0:
+            piece = fd_in.readline(max_chars)
+            if piece == '':
+                break
+            ahead.append(piece)
+            if piece.strip() != '':
+                strip = False
+                break
+            if piece.endswith('\n'):
+                lines_left -= 1
+        writers[0].close(strip)
+        fd_out.write('\n')
+        for col_no in range(1, width):
+            writers[col_no].close(strip)
+            fd_out.write('%d.%d|' % (line_no, col_no + 1))
+            spools[col_no - 1].seek(0)
+            shutil.copyfileobj(spools[col_no - 1], fd_out)
+            fd_out.write('\n')
+        fd_out.write('\n')
+    finally:
+        for spool in spools:
+            spool.close()
+    if not strip:
+        return ahead, 0
+    skipped = ''.join(ahead)
+    return [], skipped.count('\n') + (skipped[-1:] not in ('', '\n'))
+
+
+def _read_piece(fd_in, ahead, max_chars):
+    """Read up to max_chars of a line, first from a deque of pieces."""
+    if len(ahead) > 0:
+        return ahead.popleft()
+    return fd_in.readline(max_chars)
+
+
+def tr_file_bounded(table, fd_in, fd_out, matcher, max_chars, start_idx=1,
+                    buf_size=100, stats=None, memo=None):
+    """
+    Translate from one file to another with bounded memory.
+
+    This is like tr_file(), except that at most max_chars characters are
+    read at a time. Lines longer than this are translated in pieces by
+    tr_long_line(), and a buffer that grows longer than this is translated
+    early, up to its last line with text other than whitespace. That line
+    and any whitespace after it are held back until the end of the buffer
+    or another line of text is reached, since trailing whitespace is only
+    removed at the end of a buffer. The listing is then the same as that
+    of tr_file(). A matcher is required to find safe places to split.
+
+    """
+    str_buf = ''
+    tail = 0
+    written = False
+    start = start_idx
+    line_no = start_idx
+    ahead = collections.deque()
+    line = _read_piece(fd_in, ahead, max_chars)
+    while line != '':
+        long_line = len(line) >= max_chars and not line.endswith('\n')
+        while long_line and line.strip() == '':
+            piece = _read_piece(fd_in, ahead, max_chars)
+            line += piece
+            long_line = (len(piece) >= max_chars and
+                         not piece.endswith('\n'))
+        if long_line:
+            if len(str_buf) > 0:
+                tr_write(table, str_buf, start, fd_out, matcher, stats, memo,
+                         strip=False)
+                str_buf = ''
+                tail = 0
+            pieces, skipped = tr_long_line(
+                table, matcher, line, fd_in, fd_out, line_no, max_chars,
+                stats, (buf_size - line_no % buf_size) % buf_size)
+            ahead.extend(pieces)
+            written = len(pieces) > 0
+            line_no += 1 + skipped
+            start = line_no
+            line = _read_piece(fd_in, ahead, max_chars)
+            continue
+        if line.strip() != '':
+            tail = len(str_buf)
+        str_buf += line
+        line = _read_piece(fd_in, ahead, max_chars)
+        if line_no % buf_size == 0 or line == '':
+            if not written or str_buf.strip() != '':
+                tr_write(table, str_buf, start, fd_out, matcher, stats, memo)
+            str_buf = ''
+            tail = 0
+            written = False
+            start = line_no + 1
+        elif len(str_buf) >= max_chars and tail > 0:
+            tr_write(table, str_buf[:tail], start, fd_out, matcher, stats,
+                     memo, strip=False)
+            start += str_buf.count('\n', 0, tail)
+            str_buf = str_buf[tail:]
+            tail = 0
+            written = True
+        line_no += 1
+    return line_no
+
+
+def tr_file(table, fd_in, fd_out, start_idx=1, buf_size=100, matcher=None,
+            stats=None, memo=None):
+    """
+    Translate from one file to another (buffered).
+
+    Given a table, an input file object, and an output file object, apply
+    the translation table rules to the input text and write the translation
+    as a formatted string to the output. The number of the line following
+    the input text is returned. If a Counter is given for stats, then the
+    number of matches for each source term is added to it. A LineMemo may
+    be given to cache translated lines.
+
+    """
+    line_no = start_idx
+    for buffer, start in read_buffers(fd_in, start_idx, buf_size):
+        tr_write(table, buffer, start, fd_out, matcher, stats, memo)
+        line_no = next_line_no(buffer, start)
     return line_no
 
 
+def _init_worker(table, matcher, memo):
+    """Store the table, matcher, and cache for use by a worker process."""
+    _WORKER['table'] = table
+    _WORKER['matcher'] = matcher
+    _WORKER['memo'] = memo
+
+
+def _tr_worker(buffer, start, count):
+    """Translate one buffer in a worker process."""
+    stats = collections.Counter() if count else None
+    renormalized = szu_nfc.COUNTS.copy()
+    listing = tr_fmt(_WORKER['table'], buffer, start, _WORKER['matcher'],
+                     stats, _WORKER['memo'])
+    return listing, stats, szu_nfc.COUNTS - renormalized
+
+
+def tr_pool(table, fds_in, fd_out, jobs, start_idx=1, buf_size=100,
+            matcher=None, stats=None, memo=None):
+    """
+    Translate from a sequence of files to one file with a process pool.
+
+    Given a table, an iterable of input file objects, and an output file
+    object, translate the buffers of all input files in parallel and write
+    the listings in their original order. Line numbers continue from one
+    input file to the next, so the output is identical to that of calling
+    tr_file() on each file in turn. The table is sent to each worker once,
+    and only a limited number of buffers are read ahead of the output. The
+    number of the line following the input text is returned. If a Counter
+    is given for stats, then the counts from all workers are added to it.
+    If a LineMemo is given, then each worker starts with its own copy.
+
+    """
+    line_no = start_idx
+    count = stats is not None
+    with multiprocessing.Pool(
+            jobs, _init_worker, (table, matcher, memo)) as pool:
+        pending = collections.deque()
+        for fd_in in fds_in:
+            for buffer, start in read_buffers(fd_in, line_no, buf_size):
+                pending.append(pool.apply_async(
+                    _tr_worker, (buffer, start, count)))
+                if len(pending) >= jobs * 4:
+                    _write_result(pending.popleft().get(), fd_out, stats)
+                line_no = next_line_no(buffer, start)
+        while len(pending) > 0:
+            _write_result(pending.popleft().get(), fd_out, stats)
+    return line_no
+
+
+def _write_result(result, fd_out, stats):
+    """Write the listing from a worker, and add its counts to stats."""
+    listing, counts, renormalized = result
+    fd_out.write(listing)
+    szu_nfc.COUNTS.update(renormalized)
+    if stats is not None:
+        stats.update(counts)
+
+
+def write_stats(table, stats, fd_out):
+    """
+    Write rule hit counts to a file object.
+
+    Each source term with at least one match is written with its count, as
+    "term|count", with the most frequently matched terms first. Terms with
+    equal counts are written in table order.
+
+    """
+    order = {}
+    for idx, rec in enumerate(table):
+        order.setdefault(rec[0], idx)
+    terms = [term for term in stats if stats[term] > 0]
+    terms.sort(key=lambda term: (-stats[term], order.get(term, -1)))
+    for term in terms:
+        fd_out.write('%s|%d\n' % (term, stats[term]))
+
+
+def write_pruned(table, stats, fd_out):
+    """
+    Write a pruned translation table to a file object.
+
+    Only the first rule for each source term with at least one match is
+    written, in table order. For the same texts, the pruned table gives
+    the same translations as the full table.
+
+    """
+    seen = set()
+    for rec in table:
+        if stats[rec[0]] > 0 and rec[0] not in seen:
+            seen.add(rec[0])
+            fd_out.write('|'.join(rec) + '\n')
+
+
+def open_files(file_paths):
+    """Open text files in turn for reading (generator)."""
+    for file_path in file_paths:
+        with open(file_path, 'r', encoding='utf-8-sig') as fin:
+            yield fin
+
+
+def read_listing(fd_in):
+    """
+    Read a formatted listing from a file object. Return a list of lines.
+
+    Each element of the result is a (line_no, columns) pair, where columns
+    is a list holding the text of each column for that line number.
+
+    """
+    lines = []
+    for record in fd_in:
+        record = record.rstrip('\n')
+        if record == '':
+            continue
+        num, text = record.split('|', 1)
+        line_no = int(num.split('.', 1)[0])
+        if len(lines) == 0 or lines[-1][0] != line_no:
+            lines.append((line_no, []))
+        lines[-1][1].append(text)
+    return lines
+
+
+def changed_terms(old_table, new_table):
+    """
+    Compare two translation tables. Return the set of changed terms.
+
+    A source term is changed if its rule was added, removed, or modified.
+    If the tables have different widths, or if the rules that they have in
+    common are in a different order, then every translation may change and
+    None is returned instead.
+
+    """
+    if len(old_table) > 0 and len(new_table) > 0:
+        if len(old_table[0]) != len(new_table[0]):
+            return None
+    old_rules = {}
+    for rec in old_table:
+        old_rules.setdefault(rec[0], rec)
+    new_rules = {}
+    for rec in new_table:
+        new_rules.setdefault(rec[0], rec)
+    old_order = [t for t in old_rules if t in new_rules]
+    new_order = [t for t in new_rules if t in old_rules]
+    if old_order != new_order:
+        return None
+    terms = set()
+    for term in set(old_rules) | set(new_rules):
+        if old_rules.get(term) != new_rules.get(term):
+            terms.add(term)
+    return terms
+
+
+def index_terms(terms, texts):
+    """
+    Index the occurrences of source terms in texts.
+
+    Return a dictionary mapping each term that occurs in the texts to a
+    list of the indices of the texts in which it occurs. Each text is
+    scanned once, using a matcher for the given terms.
+
+    """
+    matcher = make_matcher([[term] for term in sorted(terms)])
+    keys = sorted(terms)
+    index = {}
+    for text_idx, text in enumerate(texts):
+        length = len(text)
+        for start in range(length):
+            end = start + 1
+            idx = matcher.get(text[start])
+            while idx is not None:
+                if idx >= 0:
+                    found = index.setdefault(keys[idx], [])
+                    if len(found) == 0 or found[-1] != text_idx:
+                        found.append(text_idx)
+                end += 1
+                if end > length:
+                    break
+                idx = matcher.get(text[start:end])
+    return index
+
+
+def tr_update(table, matcher, old_table, fd_in, fd_out, memo=None):
+    """
+    Update a formatted listing after changes to a translation table.
+
+    Given the new table and its matcher, the old table, and a listing made
+    with the old table, write an updated listing to the output file object.
+    Only lines containing a changed source term are translated again, and
+    all other lines of the listing are copied unchanged. The number of
+    lines translated and the total number of lines are returned.
+
+    """
+    lines = read_listing(fd_in)
+    terms = changed_terms(old_table, table)
+    width = len(table[0])
+    if terms is None:
+        affected = set(range(0, len(lines)))
+    else:
+        index = index_terms(terms, [cols[0] for _, cols in lines])
+        affected = set(i for found in index.values() for i in found)
+        for i, (_, cols) in enumerate(lines):
+            if len(cols) != width:
+                affected.add(i)
+    batch = []
+    for i, (line_no, cols) in enumerate(lines):
+        if i in affected:
+            cols = [c.rstrip('\n') for c in tr_line(
+                table, matcher, cols[0] + '\n', memo=memo)]
+        for col_idx, text in enumerate(cols):
+            batch.append('%d.%d|%s\n' % (line_no, col_idx + 1, text))
+        batch.append('\n')
+        if len(batch) >= 512:
+            fd_out.write(''.join(batch))
+            batch = []
+    fd_out.write(''.join(batch))
+    return len(affected), len(lines)
+
+
+class TableState:
+    """
+    A translation table that is reloaded when its file changes.
+
+    The table, its matcher, its line cache, and the file status are kept
+    together in one tuple, which is replaced as a whole after a reload.
+    Callers that have already taken the current tuple keep using the old
+    table until they are finished with it. If a changed table cannot be
+    loaded, the previously loaded table is kept, and the error is kept in
+    the reload_error attribute until the table is loaded successfully.
+
+    """
+
+    def __init__(self, table_fpath, engine='replace', cache=False,
+                 memo_size=0):
+        self.table_fpath = table_fpath
+        self.engine = engine
+        self.cache = cache
+        self.memo_size = memo_size
+        self.lock = threading.Lock()
+        self.current = self.load()
+        self.failed_status = None
+        self.reload_error = None
+
+    def load(self):
+        """Load the table file. Return a (status, table, matcher, memo)."""
+        table_stat = os.stat(self.table_fpath)
+        table, matcher = open_table(self.table_fpath, self.engine, self.cache)
+        memo = None
+        if matcher is not None and self.memo_size > 0:
+            memo = LineMemo(self.memo_size)
+        status = table_stat.st_size, table_stat.st_mtime_ns
+        return status, table, matcher, memo
+
+    def get(self):
+        """Return the current (status, table, matcher, memo) tuple."""
+        current = self.current
+        try:
+            table_stat = os.stat(self.table_fpath)
+        except OSError:
+            return current
+        status = table_stat.st_size, table_stat.st_mtime_ns
+        if status != current[0] and status != self.failed_status:
+            if self.lock.acquire(blocking=False):
+                try:
+                    self.current = current = self.load()
+                    self.failed_status = None
+                    self.reload_error = None
+                except (OSError, RuntimeError, ValueError) as err:
+                    self.failed_status = status
+                    self.reload_error = str(err)
+                    sys.stderr.write('szu-t: Reload failed: ' + str(err)
+                                     + '\n')
+                finally:
+                    self.lock.release()
+        return current
+
+
+def serve_request(state, line):
+    """
+    Answer one translation request. Return a JSON response string.
+
+    A request is a JSON object with the text to translate in "text", and
+    optionally the first line number in "start" (default 1). The response
+    is a JSON object with the formatted listing in "listing", or a message
+    in "error" if the request failed. Any "id" in the request is copied to
+    the response. If a changed table could not be reloaded, the previous
+    table is used, and the reload error is given in "reload_error". The
+    request line may be given as a string or as UTF-8 bytes.
+
+    """
+    response = {}
+    try:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8-sig')
+        request = json.loads(line)
+        if 'id' in request:
+            response['id'] = request['id']
+        _, table, matcher, memo = state.get()
+        if state.reload_error is not None:
+            response['reload_error'] = state.reload_error
+        response['listing'] = tr_fmt(
+            table, request['text'], int(request.get('start', 1)), matcher,
+            memo=memo)
+    except Exception as err:
+        response['error'] = str(err)
+    return json.dumps(response, ensure_ascii=False) + '\n'
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Handle JSON-lines translation requests on one connection."""
+
+    def handle(self):
+        for line in self.rfile:
+            if line.strip() != b'':
+                response = serve_request(self.server.state, line)
+                self.wfile.write(response.encode('utf-8'))
+
+
+def is_socket(fpath):
+    """Return True if a path exists and is a socket (not following links)."""
+    try:
+        return stat.S_ISSOCK(os.lstat(fpath).st_mode)
+    except OSError:
+        return False
+
+
+def serve(state, sock_path):
+    """
+    Serve translation requests for a table state (blocking).
+
+    Requests are read as JSON lines, and each connection is handled in a
+    separate thread. If the socket path is "-", then requests are read
+    from standard input and answered on standard output instead. A stale
+    socket left at the socket path is replaced, but any other existing
+    file is an error.
+
+    """
+    if sock_path == '-':
+        for line in sys.stdin:
+            if line.strip() != '':
+                sys.stdout.write(serve_request(state, line))
+        return
+    if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+        raise RuntimeError('Unix sockets are not supported')
+    if is_socket(sock_path):
+        os.unlink(sock_path)
+    elif os.path.lexists(sock_path):
+        raise RuntimeError('Not a socket: ' + sock_path)
+    server = socketserver.ThreadingUnixStreamServer(
+        sock_path, _RequestHandler)
+    server.daemon_threads = True
+    server.state = state
+    if 'SIGTERM' in dir(signal):
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if is_socket(sock_path):
+            os.unlink(sock_path)
+
+
 def main(argv):
     """
     Run as a portable command-line program.
@@ -180,29 +1216,137 @@ def main(argv):
     if 'SIGPIPE' in dir(signal):
         signal.signal(signal.SIGPIPE, signal.SIG_DFL)
     verbose = False
+    cache = False
+    engine = 'replace'
+    jobs = 1
+    sock_path = None
+    stats_fpath = None
+    prune_fpath = None
+    memo_size = 0
+    memo_fpath = None
+    listing_fpath = None
+    old_fpath = None
+    max_chars = None
     try:
-        opts, args = getopt.getopt(argv[1:], 'hv', ['help', 'verbose'])
-        for option, _ in opts:
+        opts, args = getopt.getopt(
+            argv[1:], 'ce:hj:l:m:M:p:s:S:T:u:v',
+            ['cache', 'engine=', 'help', 'jobs=', 'max-chars=', 'memo=',
+             'memo-file=', 'old-table=', 'prune=', 'serve=', 'stats=',
+             'update=', 'verbose'])
+        for option, value in opts:
+            if option in ('-c', '--cache'):
+                cache = True
+            if option in ('-e', '--engine'):
+                if value not in ('replace', 'trie'):
+                    raise RuntimeError('Unknown engine: ' + value)
+                engine = value
             if option in ('-h', '--help'):
                 print(USAGE, end='')
                 return 0
+            if option in ('-j', '--jobs'):
+                if not value.isdigit() or int(value) < 1:
+                    raise RuntimeError('Invalid number of jobs: ' + value)
+                jobs = int(value)
+            if option in ('-l', '--max-chars'):
+                if not value.isdigit() or int(value) < 1:
+                    raise RuntimeError('Invalid character limit: ' + value)
+                max_chars = int(value)
+            if option in ('-m', '--memo'):
+                if not value.isdigit():
+                    raise RuntimeError('Invalid cache size: ' + value)
+                memo_size = int(value)
+            if option in ('-M', '--memo-file'):
+                memo_fpath = value
+            if option in ('-p', '--prune'):
+                prune_fpath = value
+            if option in ('-s', '--serve'):
+                sock_path = value
+            if option in ('-S', '--stats'):
+                stats_fpath = value
+            if option in ('-T', '--old-table'):
+                old_fpath = value
+            if option in ('-u', '--update'):
+                listing_fpath = value
             if option in ('-v', '--verbose'):
                 verbose = True
         if len(args) < 1:
             sys.stderr.write(USAGE)
             return 1
-        with open(args[0], 'r', encoding='utf-8-sig') as table_fd:
-            table = read_table(table_fd)
+        if memo_size > 0 and engine != 'trie':
+            raise RuntimeError('--memo requires the trie engine')
+        if memo_fpath is not None and jobs > 1:
+            raise RuntimeError('--memo-file requires a single job')
+        if sock_path is not None:
+            serve(TableState(args[0], engine, cache, memo_size), sock_path)
+            return 0
+        if listing_fpath is not None:
+            if old_fpath is None:
+                raise RuntimeError('No old table given for --update')
+            table, matcher = open_table(args[0], 'trie', cache)
+            with open(old_fpath, 'r', encoding='utf-8-sig') as table_fd:
+                old_table = read_table(table_fd)
+            with open(listing_fpath, 'r', encoding='utf-8-sig') as fin:
+                count, total = tr_update(
+                    table, matcher, old_table, fin, sys.stdout)
+            if verbose:
+                sys.stderr.write('szu-t: translated %d of %d lines\n' % (
+                    count, total))
+                sys.stderr.write('szu-t: ' + szu_nfc.summary() + '\n')
+            return 0
+        table, matcher = open_table(args[0], engine, cache)
+        if max_chars is not None and (matcher is None or jobs > 1):
+            raise RuntimeError('--max-chars requires the trie engine and '
+                               'a single job')
+        memo = None
+        if memo_size > 0:
+            memo = LineMemo(memo_size, table_key(args[0]))
+            if memo_fpath is not None:
+                memo.load(memo_fpath)
+        stats = None
+        if stats_fpath is not None or prune_fpath is not None:
+            stats = collections.Counter()
         if len(args) == 1:
             if sys.stdin.isatty():
-                tr_file(table, sys.stdin, sys.stdout, start_idx=1, buf_size=1)
+                tr_file(table, sys.stdin, sys.stdout, start_idx=1, buf_size=1,
+                        matcher=matcher, stats=stats, memo=memo)
+            elif jobs > 1:
+                tr_pool(table, [sys.stdin], sys.stdout, jobs, matcher=matcher,
+                        stats=stats, memo=memo)
+            elif max_chars is not None:
+                tr_file_bounded(table, sys.stdin, sys.stdout, matcher,
+                                max_chars, stats=stats, memo=memo)
             else:
-                tr_file(table, sys.stdin, sys.stdout)
+                tr_file(table, sys.stdin, sys.stdout, matcher=matcher,
+                        stats=stats, memo=memo)
+        elif jobs > 1:
+            tr_pool(table, open_files(args[1:]), sys.stdout, jobs,
+                    matcher=matcher, stats=stats, memo=memo)
         else:
             idx = 1
             for file_path in args[1:]:
                 with open(file_path, 'r', encoding='utf-8-sig') as fin:
-                    idx = tr_file(table, fin, sys.stdout, idx)
+                    if max_chars is not None:
+                        idx = tr_file_bounded(
+                            table, fin, sys.stdout, matcher, max_chars, idx,
+                            stats=stats, memo=memo)
+                    else:
+                        idx = tr_file(table, fin, sys.stdout, idx,
+                                      matcher=matcher, stats=stats, memo=memo)
+        if stats_fpath is not None:
+            with open(stats_fpath, 'w', encoding='utf-8') as fout:
+                write_stats(table, stats, fout)
+        if prune_fpath is not None:
+            with open(prune_fpath, 'w', encoding='utf-8') as fout:
+                write_pruned(table, stats, fout)
+        if memo is not None:
+            if memo_fpath is not None:
+                memo.save(memo_fpath)
+            if verbose and jobs == 1:
+                sys.stderr.write('szu-t: line cache: %d hits, %d misses '
+                                 '(%.1f%%)\n' % (memo.hits, memo.misses,
+                                                  100 * memo.hit_rate()))
+        if verbose:
+            sys.stderr.write('szu-t: ' + szu_nfc.summary() + '\n')
         return 0
     except KeyboardInterrupt:
         print()
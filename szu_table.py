@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2014-2015 the Sanzang authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Sanzang program module for compact translation tables."""
+
+
+import array
+import collections.abc
+
+
+class Table(collections.abc.Sequence):
+    """
+    A translation table kept in one string with an array of offsets.
+
+    The records are stored in the table format, one per line with fields
+    separated by "|", in a single string, and an array holds the offset at
+    which each record begins. A record is only split into a list of fields
+    when it is accessed, so a large table takes a fraction of the memory
+    of a list of lists, and it is copied to worker processes or a cache
+    file as one string and one array.
+
+    """
+
+    __slots__ = ('text', 'starts')
+
+    def __init__(self, text='', starts=None):
+        self.text = text
+        self.starts = array.array('Q', [0] if starts is None else starts)
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Make a table from formatted records, without line endings."""
+        parts = []
+        starts = array.array('Q', [0])
+        pos = 0
+        for line in lines:
+            parts.append(line)
+            pos += len(line) + 1
+            starts.append(pos)
+        parts.append('')
+        return cls('\n'.join(parts), starts)
+
+    @classmethod
+    def from_records(cls, records):
+        """Make a table from records given as sequences of fields."""
+        return cls.from_lines('|'.join(rec) for rec in records)
+
+    @classmethod
+    def from_state(cls, state):
+        """Make a table from the (text, bytes) pair given by state()."""
+        starts = array.array('Q')
+        starts.frombytes(state[1])
+        return cls(state[0], starts)
+
+    def state(self):
+        """Return the table as a (text, bytes) pair of builtin types."""
+        return self.text, self.starts.tobytes()
+
+    def __reduce__(self):
+        return Table, (self.text, self.starts)
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('table index out of range')
+        return self.text[self.starts[idx]:self.starts[idx + 1] - 1].split('|')
+
+    def __iter__(self):
+        text = self.text
+        starts = self.starts
+        for idx in range(len(starts) - 1):
+            yield text[starts[idx]:starts[idx + 1] - 1].split('|')
+
+    def line(self, idx):
+        """Return a record as a formatted line, without its line ending."""
+        return self.text[self.starts[idx]:self.starts[idx + 1] - 1]
+
+    def terms(self):
+        """Yield the first field (the source term) of each record."""
+        text = self.text
+        starts = self.starts
+        for idx in range(len(starts) - 1):
+            end = starts[idx + 1] - 1
+            sep = text.find('|', starts[idx], end)
+            yield text[starts[idx]:end if sep == -1 else sep]
+
+    def term(self, idx):
+        """Return the first field (the source term) of a record."""
+        start = self.starts[idx]
+        end = self.starts[idx + 1] - 1
+        sep = self.text.find('|', start, end)
+        return self.text[start:end if sep == -1 else sep]
+
+
+def term_key(term):
+    """Return the sort key of a source term: longest terms first."""
+    return -len(term), term
+
+
+class TableMap(collections.abc.MutableMapping):
+    """
+    A dictionary of table rules backed by a compact table.
+
+    Each key is a source term, and each value is the list of the other
+    fields of its rule. The rules of the table are found by binary search
+    in an array of record indices in sorted order (as given by term_key),
+    keeping only the last record for each source term, and changes are
+    kept in a separate dictionary, in which a removed term maps to None.
+
+    """
+
+    def __init__(self, table=None):
+        self.table = Table() if table is None else table
+        self.changes = {}
+        terms = list(self.table.terms())
+        order = sorted(range(len(terms)), key=lambda i: term_key(terms[i]))
+        self.order = array.array('Q', (
+            order[i] for i in range(len(order)) if i + 1 == len(order)
+            or terms[order[i]] != terms[order[i + 1]]))
+        self.length = len(self.order)
+
+    def find(self, term):
+        """Return the index of the record for a term in the table, or -1."""
+        key = term_key(term)
+        low = 0
+        high = len(self.order)
+        while low < high:
+            mid = (low + high) // 2
+            if term_key(self.table.term(self.order[mid])) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self.order) and self.table.term(self.order[low]) == term:
+            return self.order[low]
+        return -1
+
+    def __contains__(self, term):
+        if term in self.changes:
+            return self.changes[term] is not None
+        return self.find(term) != -1
+
+    def __getitem__(self, term):
+        if term in self.changes:
+            value = self.changes[term]
+        else:
+            idx = self.find(term)
+            value = None if idx == -1 else self.table[idx][1:]
+        if value is None:
+            raise KeyError(term)
+        return value
+
+    def __setitem__(self, term, value):
+        if term not in self:
+            self.length += 1
+        self.changes[term] = value
+
+    def __delitem__(self, term):
+        if term not in self:
+            raise KeyError(term)
+        self.length -= 1
+        self.changes[term] = None
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for term, _ in self.iter_items():
+            yield term
+
+    def iter_items(self):
+        """Yield (term, value) pairs: table rules first, then additions."""
+        for idx in self.order:
+            rec = self.table[idx]
+            if rec[0] not in self.changes:
+                yield rec[0], rec[1:]
+        for term, value in self.changes.items():
+            if value is not None:
+                yield term, value
+
+    def items(self):
+        return _TableItems(self)
+
+
+class _TableItems(collections.abc.ItemsView):
+    """An items view of a TableMap that reads each record only once."""
+
+    def __iter__(self):
+        return self._mapping.iter_items()
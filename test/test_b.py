@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2014-2015 the Sanzang authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Tests for planning batches in szu-b."""
+
+
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import szu_b  # noqa: E402
+
+
+SECOND = 10 ** 9
+B_PATH = os.path.join('sub', 'b.txt')
+
+
+def write_file(fpath, text, mtime_ns):
+    """Write a text file, creating directories, and set its mtime."""
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    with open(fpath, 'w', encoding='utf-8') as fout:
+        fout.write(text)
+    os.utime(fpath, ns=(mtime_ns, mtime_ns))
+
+
+class TestPlanBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.in_dir = os.path.join(self.tmp_dir.name, 'in')
+        self.out_dir = os.path.join(self.tmp_dir.name, 'out')
+        write_file(os.path.join(self.in_dir, 'a.txt'), 'a', 10 * SECOND)
+        write_file(os.path.join(self.in_dir, 'sub', 'b.txt'), 'b',
+                   10 * SECOND)
+        write_file(os.path.join(self.out_dir, 'a.txt'), 'A', 20 * SECOND)
+        write_file(os.path.join(self.out_dir, 'sub', 'b.txt'), 'B',
+                   20 * SECOND)
+        self.in_files = list(szu_b.find_files([self.in_dir]))
+        self.settings = 'table 1'
+        self.digest = hashlib.sha1(b'table 1').hexdigest()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def plan(self, manifest, settings=None, use_hash=False, mtime_ns=0):
+        """Plan the batch. Return the relative output paths and the count."""
+        tasks, current = szu_b.plan_batch(
+            self.in_files, self.out_dir, manifest,
+            self.settings if settings is None else settings, use_hash,
+            mtime_ns)
+        return [os.path.relpath(task[1], self.out_dir)
+                for task in tasks], current
+
+    def test_find_files(self):
+        self.assertEqual([rel_path for _, rel_path in self.in_files],
+                         ['a.txt', B_PATH])
+
+    def test_up_to_date(self):
+        in_fpath = os.path.join(self.in_dir, 'a.txt')
+        out_fpath = os.path.join(self.out_dir, 'a.txt')
+        self.assertTrue(szu_b.up_to_date(in_fpath, out_fpath, 0))
+        self.assertTrue(szu_b.up_to_date(in_fpath, out_fpath, 20 * SECOND))
+        self.assertFalse(szu_b.up_to_date(in_fpath, out_fpath, 30 * SECOND))
+        self.assertFalse(szu_b.up_to_date(out_fpath, in_fpath, 0))
+        self.assertFalse(szu_b.up_to_date(
+            in_fpath, os.path.join(self.out_dir, 'c.txt'), 0))
+
+    def test_mtime_mode(self):
+        manifest = {'a.txt': self.digest, B_PATH: self.digest}
+        self.assertEqual(self.plan(manifest), ([], 2))
+        self.assertEqual(self.plan({}), (['a.txt', B_PATH], 0))
+        self.assertEqual(self.plan(manifest, 'table 2'),
+                         (['a.txt', B_PATH], 0))
+        self.assertEqual(self.plan(manifest, mtime_ns=30 * SECOND),
+                         (['a.txt', B_PATH], 0))
+        write_file(os.path.join(self.in_dir, 'a.txt'), 'a', 30 * SECOND)
+        self.assertEqual(self.plan(manifest), (['a.txt'], 1))
+
+    def test_hash_mode(self):
+        manifest = {}
+        for in_fpath, rel_path in self.in_files:
+            manifest[rel_path] = szu_b.file_digest(in_fpath, self.settings)
+        write_file(os.path.join(self.in_dir, 'a.txt'), 'a', 30 * SECOND)
+        self.assertEqual(self.plan(manifest, use_hash=True), ([], 2))
+        self.assertEqual(self.plan(manifest, 'table 2', use_hash=True),
+                         (['a.txt', B_PATH], 0))
+        write_file(os.path.join(self.in_dir, 'a.txt'), 'c', 10 * SECOND)
+        self.assertEqual(self.plan(manifest, use_hash=True), (['a.txt'], 1))
+        os.remove(os.path.join(self.out_dir, 'sub', 'b.txt'))
+        self.assertEqual(self.plan(manifest, use_hash=True),
+                         (['a.txt', B_PATH], 0))
+
+    def test_same_output_path(self):
+        a_fpath = os.path.join(self.in_dir, 'a.txt')
+        self.in_files = [(a_fpath, 'a.txt'), (a_fpath, 'a.txt')]
+        self.assertEqual(self.plan({}), (['a.txt'], 0))
+        self.in_files.append((os.path.join(self.in_dir, 'sub', 'b.txt'),
+                              'a.txt'))
+        with self.assertRaisesRegex(RuntimeError, 'same output path'):
+            self.plan({})
+
+
+if __name__ == '__main__':
+    unittest.main()
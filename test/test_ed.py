@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2014-2015 the Sanzang authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Tests for the journal and table merging of szu-ed."""
+
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import szu_ed  # noqa: E402
+
+
+def read_file(fpath):
+    """Return the contents of a text file."""
+    with open(fpath, 'r', encoding='utf-8') as fin:
+        return fin.read()
+
+
+def write_file(fpath, text):
+    """Replace the contents of a text file."""
+    with open(fpath, 'w', encoding='utf-8') as fout:
+        fout.write(text)
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.table_fpath = os.path.join(self.tmp_dir.name, 'table.txt')
+        self.journal_fpath = self.table_fpath + '.journal'
+        write_file(self.table_fpath, 'ab|x\na|y\n')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def edit(self, lines, **options):
+        """Run the editor quietly. Return the messages on stderr."""
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err), \
+                contextlib.redirect_stdout(io.StringIO()):
+            szu_ed.edit(self.table_fpath, lines, **options)
+        return err.getvalue()
+
+    def crash(self, changes, committed):
+        """Journal changes, commit the first ones, and stop."""
+        with open(self.table_fpath, 'r', encoding='utf-8') as fin:
+            tab, _ = szu_ed.read_table(fin.read())
+        log = szu_ed.Journal(self.table_fpath)
+        for term, value in changes[:committed]:
+            log.record(tab, term, value)
+        log.commit()
+        for term, value in changes[committed:]:
+            log.record(tab, term, value)
+        log.fd_out.close()
+
+    def test_journal_saves(self):
+        self.edit(['c|z', '\\w', '\\rm', 'a', '\\w', '\\q'], journal=True)
+        self.assertEqual(read_file(self.table_fpath), 'ab|x\nc|z\n')
+        self.assertFalse(os.path.exists(self.journal_fpath))
+
+    def test_replay(self):
+        self.crash([('c', ['z']), ('a', None), ('ab', ['w'])], 2)
+        err = self.edit(['\\q'])
+        self.assertIn('(2 changes recovered)', err)
+        self.assertEqual(read_file(self.table_fpath), 'ab|x\nc|z\n')
+        self.assertFalse(os.path.exists(self.journal_fpath))
+
+    def test_replay_partial_line(self):
+        self.crash([('c', ['z'])], 1)
+        with open(self.journal_fpath, 'a', encoding='utf-8') as fout:
+            fout.write('+d|')
+        self.edit(['\\q'])
+        self.assertEqual(read_file(self.table_fpath), 'ab|x\na|y\nc|z\n')
+
+    def test_interrupted_compaction(self):
+        self.crash([('c', ['z'])], 1)
+        journal = read_file(self.journal_fpath)
+        write_file(self.table_fpath, 'ab|x\na|y\nc|z\n')
+        stamp = szu_ed.table_stamp(self.table_fpath)
+        write_file(self.journal_fpath, journal + '!' + stamp + '\n')
+        self.assertEqual(
+            szu_ed.Journal(self.table_fpath).replay({}, 2), (2, 0))
+        err = self.edit(['\\rm', 'c', '\\q'], batch=True)
+        self.assertNotIn('recovered', err)
+        self.assertEqual(read_file(self.table_fpath), 'ab|x\na|y\n')
+        self.assertFalse(os.path.exists(self.journal_fpath))
+
+    def test_stale_journal(self):
+        self.crash([('c', ['z'])], 1)
+        write_file(self.table_fpath, 'ab|x\na|y\nb|v\n')
+        err = self.edit(['\\q'])
+        self.assertIn('journal does not match table', err)
+        self.assertEqual(read_file(self.table_fpath), 'ab|x\na|y\nb|v\n')
+        self.assertFalse(os.path.exists(self.journal_fpath))
+        self.assertIn('+c|z\n', read_file(self.journal_fpath + '.stale'))
+
+
+def merge(tables, prefer='last'):
+    """Merge tables given as strings. Return the result and the counts."""
+    fd_out = io.StringIO()
+    counts = szu_ed.merge_tables([io.StringIO(t) for t in tables], fd_out,
+                                 prefer)
+    return fd_out.getvalue(), counts
+
+
+class TestMerge(unittest.TestCase):
+
+    def test_union(self):
+        self.assertEqual(merge(['abc|1\nb|2\n', 'ab|3\nc|4\n', '']),
+                         ('abc|1\nab|3\nb|2\nc|4\n', (4, 0)))
+
+    def test_duplicates(self):
+        self.assertEqual(merge(['ab|1\nb|2\n', 'b|2\n'], 'error'),
+                         ('ab|1\nb|2\n', (2, 0)))
+
+    def test_conflicts(self):
+        tables = ['ab|1\nb|2\n', 'ab|3\nb|2\n', 'ab|4\n']
+        self.assertEqual(merge(tables, 'first'), ('ab|1\nb|2\n', (2, 1)))
+        self.assertEqual(merge(tables, 'last'), ('ab|4\nb|2\n', (2, 1)))
+        with self.assertRaisesRegex(RuntimeError, 'Conflicting rules: ab'):
+            merge(tables, 'error')
+
+    def test_widths(self):
+        fd_out = io.StringIO()
+        tables = ['ab|1\nb|2\n', 'c|3|4\n']
+        with self.assertRaisesRegex(RuntimeError, 'different widths: 2, 3'):
+            szu_ed.merge_tables([io.StringIO(t) for t in tables], fd_out)
+        self.assertEqual(fd_out.getvalue(), '')
+
+    def test_width_in_table(self):
+        with self.assertRaisesRegex(RuntimeError, 'Table error: b'):
+            merge(['ab|1\nb|2|3\n'])
+
+    def test_unsorted(self):
+        with self.assertRaisesRegex(RuntimeError, 'Table not sorted'):
+            merge(['b|1\nab|2\n'])
+
+    def test_diff(self):
+        fd_out = io.StringIO()
+        counts = szu_ed.diff_tables(io.StringIO('ab|1\nb|2\nc|3\n'),
+                                    io.StringIO('ab|4\nc|3\nd|5\n'), fd_out)
+        self.assertEqual(fd_out.getvalue(), '<ab|1\n>ab|4\n-b|2\n+d|5\n')
+        self.assertEqual(counts, {'added': 1, 'changed': 1, 'removed': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2014-2015 the Sanzang authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Tests for the szu-p pipeline."""
+
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import szu_p  # noqa: E402
+import szu_r  # noqa: E402
+import szu_ss  # noqa: E402
+import szu_t  # noqa: E402
+import szu_table  # noqa: E402
+
+
+TEXT = ('\u5982\u662f\u6211\u805e\u3002\u4e00\u6642\n\u4f5b\u5728\u8209'
+        '\u85a9\u7f85\u570b\u3002\n\n\u723e\u6642\u4e16\u5c0a\u3002\n') * 40
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.table = szu_table.Table.from_records([
+            ['\u5982\u662f', 'thus', 'THUS'], ['\u4f5b', 'buddha', 'B'],
+            ['\u4e16\u5c0a', 'lord', 'L'], ['\u6211', 'I', 'I']])
+        self.ss_table = szu_table.Table.from_lines([
+            '\u805e|\u95fb', '\u8209|\u8202'])
+
+    def separate(self, reflow):
+        """Run each program on the output of the last. Return the result."""
+        text = TEXT
+        if reflow:
+            fd_out = io.StringIO()
+            szu_r.reflow_file(io.StringIO(text), fd_out)
+            text = fd_out.getvalue()
+        fd_out = io.StringIO()
+        szu_ss.subst_file(self.ss_table, io.StringIO(text), fd_out)
+        text = fd_out.getvalue()
+        fd_out = io.StringIO()
+        szu_t.tr_file(self.table, io.StringIO(text), fd_out)
+        return fd_out.getvalue()
+
+    def pipeline(self, reflow, parallel, engine):
+        """Run the pipeline. Return the result."""
+        matcher = szu_t.make_matcher(self.table) if engine == 'trie' else None
+        ss_options = {'matcher': szu_ss.make_matcher(self.ss_table),
+                      'cascade': szu_ss.cascade_rules(self.ss_table),
+                      'runs': szu_ss.char_runs(self.ss_table),
+                      'steps': szu_ss.rule_steps(self.ss_table)}
+        fd_out = io.StringIO()
+        szu_p.pipeline([io.StringIO(TEXT[:500]), io.StringIO(TEXT[500:])],
+                       fd_out, self.table, matcher, self.ss_table, ss_options,
+                       reflow, parallel)
+        return fd_out.getvalue()
+
+    def test_same_output(self):
+        for reflow in (False, True):
+            expected = self.separate(reflow)
+            self.assertIn(' buddha ', expected)
+            for engine in ('replace', 'trie'):
+                self.assertEqual(self.pipeline(reflow, False, engine),
+                                 expected, (reflow, engine))
+
+    def test_parallel(self):
+        self.assertEqual(self.pipeline(True, True, 'trie'),
+                         self.separate(True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2014-2015 the Sanzang authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Tests for splitting long input text in szu-t and szu-ss."""
+
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import szu_nfc  # noqa: E402
+import szu_ss  # noqa: E402
+import szu_t  # noqa: E402
+import szu_table  # noqa: E402
+
+
+KANA_TEXT = ('\u304b\u3099' * 5 + 'a\n') * 3
+HANGUL_TEXT = 'zz\u1100\u1161zz\n' * 3
+
+
+def translate(text, max_chars=None, buf_size=100):
+    """Translate a text with a small table, with or without a limit."""
+    table = szu_table.Table.from_records([
+        ['\u304c', 'ga', 'GA'], ['\uac00', 'ga', 'GA'],
+        ['ab', 'x', 'X'], ['cd', 'y', 'Y']])
+    matcher = szu_t.make_matcher(table)
+    fd_out = io.StringIO()
+    if max_chars is None:
+        szu_t.tr_file(table, io.StringIO(text), fd_out, buf_size=buf_size,
+                      matcher=matcher)
+    else:
+        szu_t.tr_file_bounded(table, io.StringIO(text), fd_out, matcher,
+                              max_chars, buf_size=buf_size)
+    return fd_out.getvalue()
+
+
+def substitute(text, max_chars=None):
+    """Substitute a text with a small table, with or without a limit."""
+    table = szu_table.Table.from_lines(['\u304c|GA', '\uac00|GA'])
+    fd_out = io.StringIO()
+    szu_ss.subst_file(table, io.StringIO(text), fd_out, max_chars=max_chars)
+    return fd_out.getvalue()
+
+
+class TestNfcSafe(unittest.TestCase):
+
+    def test_starters(self):
+        for char in 'a \u304b\u4e00\uac00\u1100\uf900':
+            self.assertTrue(szu_nfc.nfc_safe(char), hex(ord(char)))
+
+    def test_composing(self):
+        for char in ('\u3099\u309a\u302a\u302f\u0301\u1161\u1175'
+                     '\u11a8\u11c2\u0b3e\u0f73'):
+            self.assertFalse(szu_nfc.nfc_safe(char), hex(ord(char)))
+
+
+class TestBoundedTranslation(unittest.TestCase):
+
+    def test_decomposed_kana(self):
+        listing = translate(KANA_TEXT)
+        self.assertIn('1.2|' + ' ga' * 5 + ' a\n', listing)
+        for max_chars in range(1, 14):
+            self.assertEqual(translate(KANA_TEXT, max_chars), listing)
+
+    def test_decomposed_hangul(self):
+        listing = translate(HANGUL_TEXT)
+        self.assertIn('1.3|zz GA zz', listing)
+        for max_chars in range(1, 8):
+            self.assertEqual(translate(HANGUL_TEXT, max_chars), listing)
+
+    def test_trailing_whitespace(self):
+        texts = ['ebbbab\nadcdab\n\nccae\n', 'abab  \n \n\nab\n',
+                 'ab\n' + ' ' * 20 + '\n\nab\n', 'cdcdcdcdcd  \n  \n',
+                 '\n\n\n\nab\n', 'ab\n  ']
+        for text in texts:
+            for buf_size in range(1, 5):
+                listing = translate(text, buf_size=buf_size)
+                for max_chars in range(1, 12):
+                    self.assertEqual(
+                        translate(text, max_chars, buf_size), listing,
+                        (text, max_chars, buf_size))
+
+
+class TestBoundedSubstitution(unittest.TestCase):
+
+    def test_decomposed_kana(self):
+        self.assertEqual(substitute(KANA_TEXT), ('GA' * 5 + 'a\n') * 3)
+        for max_chars in range(1, 14):
+            self.assertEqual(substitute(KANA_TEXT, max_chars),
+                             substitute(KANA_TEXT))
+
+    def test_decomposed_hangul(self):
+        self.assertEqual(substitute(HANGUL_TEXT), 'zzGAzz\n' * 3)
+        for max_chars in range(1, 8):
+            self.assertEqual(substitute(HANGUL_TEXT, max_chars),
+                             substitute(HANGUL_TEXT))
+
+
+if __name__ == '__main__':
+    unittest.main()
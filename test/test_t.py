@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2014-2015 the Sanzang authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Tests for the translation server and line cache of szu-t."""
+
+
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import szu_t  # noqa: E402
+import szu_table  # noqa: E402
+
+
+def write_table(fpath, data, mtime_ns):
+    """Write a table file as bytes, and set its mtime."""
+    with open(fpath, 'wb') as fout:
+        fout.write(data)
+    os.utime(fpath, ns=(mtime_ns, mtime_ns))
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.table_fpath = os.path.join(self.tmp_dir.name, 'table.txt')
+        write_table(self.table_fpath, 'ab|x\nc|y\n'.encode('utf-8'),
+                    10 ** 9)
+        self.state = szu_t.TableState(self.table_fpath, 'trie')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def request(self, line):
+        """Send one request. Return the response as a dictionary."""
+        with contextlib.redirect_stderr(io.StringIO()):
+            response = szu_t.serve_request(self.state, line)
+        self.assertTrue(response.endswith('\n'))
+        return json.loads(response)
+
+    def test_request(self):
+        self.assertEqual(
+            self.request(b'{"id": 7, "text": "abc", "start": 3}\n'),
+            {'id': 7, 'listing': '3.1|abc\n3.2| x y\n\n'})
+        self.assertEqual(self.request('{"text": "c"}'),
+                         {'listing': '1.1|c\n1.2| y\n\n'})
+
+    def test_bad_requests(self):
+        for line in (b'\xff\xfe{}\n', b'{"text": "\xe3\x81"}\n',
+                     b'not json\n', b'{"id": 1}\n'):
+            response = self.request(line)
+            self.assertIn('error', response, line)
+            self.assertNotIn('listing', response, line)
+        self.assertEqual(self.request(b'{"id": 1}\n')['id'], 1)
+
+    def test_reload(self):
+        write_table(self.table_fpath, 'ab|z\n'.encode('utf-8'), 2 * 10 ** 9)
+        self.assertEqual(self.request('{"text": "abc"}'),
+                         {'listing': '1.1|abc\n1.2| z c\n\n'})
+
+    def test_failed_reload(self):
+        write_table(self.table_fpath, b'ab|\xff\n', 2 * 10 ** 9)
+        response = self.request('{"text": "abc"}')
+        self.assertEqual(response['listing'], '1.1|abc\n1.2| x y\n\n')
+        self.assertIn('codec', response['reload_error'])
+        write_table(self.table_fpath, 'ab|z\n'.encode('utf-8'), 3 * 10 ** 9)
+        self.assertEqual(self.request('{"text": "abc"}'),
+                         {'listing': '1.1|abc\n1.2| z c\n\n'})
+
+
+class TestLineMemo(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.memo_fpath = os.path.join(self.tmp_dir.name, 'memo')
+        self.table = szu_table.Table.from_records([
+            ['ab', 'x', 'X'], ['c', 'y', 'Y']])
+        self.matcher = szu_t.make_matcher(self.table)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def translate(self, text, memo=None):
+        """Translate a text through an optional memo. Return the listing."""
+        return szu_t.tr_fmt(self.table, text, 1, self.matcher, memo=memo)
+
+    def test_same_listing(self):
+        memo = szu_t.LineMemo(2)
+        text = 'abc\ncab\nabc\nd\nabc\nab'
+        self.assertEqual(self.translate(text, memo), self.translate(text))
+        self.assertEqual(self.translate(text, memo), self.translate(text))
+        self.assertEqual(len(memo.lines), 2)
+        self.assertGreater(memo.hits, 0)
+
+    def test_save_load(self):
+        memo = szu_t.LineMemo(10, ('table', 1))
+        self.translate('abc\ncab\n', memo)
+        memo.save(self.memo_fpath)
+        memo.save(self.memo_fpath)
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['memo'])
+        loaded = szu_t.LineMemo(1, ('table', 1))
+        loaded.load(self.memo_fpath)
+        self.assertEqual(list(loaded.lines), ['cab\n'])
+        self.assertEqual(loaded.get('cab\n'), memo.get('cab\n'))
+
+    def test_load_other_table(self):
+        memo = szu_t.LineMemo(10, ('table', 1))
+        self.translate('abc\n', memo)
+        memo.save(self.memo_fpath)
+        loaded = szu_t.LineMemo(10, ('table', 2))
+        loaded.load(self.memo_fpath)
+        self.assertEqual(len(loaded.lines), 0)
+        loaded.load(os.path.join(self.tmp_dir.name, 'missing'))
+        self.assertEqual(len(loaded.lines), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()